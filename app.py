@@ -1,10 +1,16 @@
 import os
 import logging
-from flask import Flask, render_template, request, redirect, url_for, flash, send_file
+import tempfile
+from flask import Flask, render_template, request, redirect, url_for, flash, send_file, jsonify, abort, Response, stream_with_context
 from werkzeug.utils import secure_filename
-from database import init_db, get_all_records, add_record, update_record, delete_record
-from email_sender import process_email_queue, send_selected_emails
-from document_processor import generate_cv, generate_cover_letter
+from database import init_db, recover_stuck_claims, get_all_records, add_record, update_record, delete_record, search_contacts, count_sendable_contacts, enqueue_send_job, get_send_jobs, SEARCH_FACETS, EXPORT_TABLES
+from document_processor import generate_cv, generate_cover_letter, cv_context, cover_letter_context, document_key
+from storage import cached_document
+from exporter import export_rows, EXPORT_FORMATS
+from sender_accounts import AccountPool, load_accounts
+from page_cache import cached_page
+from send_worker import start_in_thread
+from profiling import PROFILING, register_request_profiling
 from logging_config import setup_logging
 
 # Set up logging first
@@ -13,25 +19,106 @@ setup_logging()
 # Get logger for this module
 logger = logging.getLogger('app')
 
+# File holding the generated session secret when SECRET_KEY is not set
+SECRET_KEY_FILE = os.environ.get('SECRET_KEY_FILE', 'secret_key')
+
+def load_secret_key(path=SECRET_KEY_FILE):
+    """
+    Return the session secret shared by every worker process.
+    
+    The SECRET_KEY environment variable wins. Otherwise the key is read from
+    path, which is created with a random key on first use, so sessions
+    survive restarts and work across workers.
+    """
+    if os.environ.get('SECRET_KEY'):
+        return os.environ['SECRET_KEY']
+    
+    if not os.path.exists(path):
+        # The key is written to a temporary file first and linked into place, so
+        # a process starting at the same time never reads a partly written key.
+        # Linking fails if another process got there first, and its key is used.
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as file:
+                file.write(os.urandom(32).hex())
+            os.link(temp_path, path)
+            logger.info(f"Generated a new session secret in {path}")
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(temp_path)
+    
+    with open(path) as file:
+        return file.read().strip()
+
 app = Flask(__name__)
-app.secret_key = os.urandom(24)
+app.secret_key = load_secret_key()
 app.config['UPLOAD_FOLDER'] = 'templates'
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max upload
 app.config['OUTPUT_DIR'] = 'output'
 
-# Ensure output directory exists
-if not os.path.exists(app.config['OUTPUT_DIR']):
-    os.makedirs(app.config['OUTPUT_DIR'])
+# ?profile=1 on any route, only wired in when PROFILING=1
+if PROFILING:
+    register_request_profiling(app)
 
-# Initialize database and log startup
+# Initialize database, resolve claims left behind by a crash and log startup.
+# The production server imports this module once before forking its workers
+# (see gunicorn.conf.py), so this runs once per start rather than once per worker.
+# Output cleanup belongs to the send worker, which writes most of the files.
 init_db()
+recover_stuck_claims()
 logger.info('Email automation application startup')
 
+# Sender accounts the batches are spread across, shown on the selection page
+sender_pool = AccountPool(load_accounts())
+
+# Contacts shown per page on the main page
+CONTACTS_PER_PAGE = 50
+
+def search_from_request():
+    """Run search_contacts with the query, facet filters and page given in the query string"""
+    filters = {name: request.args.get(name, '') for name in SEARCH_FACETS}
+    return search_contacts(
+        request.args.get('q', ''), filters,
+        page=request.args.get('page', 1, type=int),
+        per_page=request.args.get('per_page', CONTACTS_PER_PAGE, type=int)
+    ), filters
+
 @app.route('/')
+@cached_page
 def index():
     logger.info("Rendering main page")
-    records = get_all_records()
-    return render_template('index.html', records=records)
+    search, filters = search_from_request()
+    return render_template('index.html', records=search['records'], search=search,
+                           query=request.args.get('q', ''), filters=filters)
+
+@app.route('/api/search')
+@cached_page
+def api_search():
+    search, filters = search_from_request()
+    return jsonify({
+        'records': [dict(record) for record in search['records']],
+        'total': search['total'],
+        'page': search['page'],
+        'per_page': search['per_page'],
+        'pages': search['pages'],
+        'facets': {
+            name: {'' if value is None else str(value): count for value, count in counts.items()}
+            for name, counts in search['facets'].items()
+        },
+    })
+
+@app.route('/export/<table>.<export_format>')
+def export(table, export_format):
+    if table not in EXPORT_TABLES or export_format not in EXPORT_FORMATS:
+        abort(404)
+    
+    logger.info(f"Exporting {table} as {export_format}")
+    filters = {name: request.args.get(name, '') for name in SEARCH_FACETS}
+    # The generator keeps its read snapshot open until the last chunk is sent
+    stream = export_rows(table, export_format, request.args.get('q', ''), filters)
+    return Response(stream_with_context(stream), mimetype=EXPORT_FORMATS[export_format],
+                    headers={'Content-Disposition': f'attachment; filename={table}.{export_format}'})
 
 @app.route('/add', methods=['GET', 'POST'])
 def add():
@@ -92,38 +179,51 @@ def delete(id):
 
 @app.route('/send-emails')
 def send_emails():
-    logger.info("Starting email processing")
-    records = get_all_records()
-    results = process_email_queue(records)
-    logger.info(f"Processed {len(results)} emails")
-    flash(f'Processed {len(results)} emails. Check logs for details.', 'info')
+    logger.info("Queueing email processing")
+    # The send worker runs the batch, so this request returns right away
+    job_id = enqueue_send_job('all')
+    flash(f'Queued send job #{job_id}. Emails are sent in the background, check logs for details.', 'info')
     return redirect(url_for('index'))
 
+@app.route('/api/send-jobs')
+def api_send_jobs():
+    return jsonify({'jobs': get_send_jobs(request.args.get('limit', 20, type=int))})
+
+# Not cached: the account usage it shows changes without bumping the data version
 @app.route('/select-emails', methods=['GET', 'POST'])
 def select_emails():
     if request.method == 'POST':
         logger.info("Processing selected email send request")
-        selected_ids = request.form.getlist('selected_records')
-        
-        if not selected_ids:
-            flash('No records selected.', 'warning')
-            return redirect(url_for('select_emails'))
-        
-        # Get all selected records
-        selected_records = [get_all_records(int(id)) for id in selected_ids]
         
-        # Filter out None values (in case a record was deleted)
-        selected_records = [r for r in selected_records if r is not None]
+        if request.form.get('select_mode') == 'filter':
+            # The selection is a search, resolved and streamed by the server
+            query = request.form.get('q', '')
+            filters = {name: request.form.get(name, '') for name in SEARCH_FACETS}
+            
+            if not count_sendable_contacts(query, filters):
+                flash('No pending contacts match this search.', 'warning')
+                return redirect(url_for('select_emails'))
+            
+            logger.info(f"Queueing pending contacts matching query '{query}' and filters {filters}")
+            job_id = enqueue_send_job('filter', {'q': query, 'filters': filters})
+        else:
+            selected_ids = request.form.getlist('selected_records')
+            
+            if not selected_ids:
+                flash('No records selected.', 'warning')
+                return redirect(url_for('select_emails'))
+            
+            job_id = enqueue_send_job('selected', {'ids': [int(id) for id in selected_ids]})
         
-        # Process selected records
-        results = send_selected_emails(selected_records)
-        logger.info(f"Processed {len(results)} selected emails")
-        flash(f'Processed {len(results)} emails. Check logs for details.', 'info')
+        flash(f'Queued send job #{job_id}. Emails are sent in the background, check logs for details.', 'info')
         return redirect(url_for('index'))
     
     logger.info("Rendering email selection page")
-    records = get_all_records()
-    return render_template('select_emails.html', records=records)
+    search, filters = search_from_request()
+    query = request.args.get('q', '')
+    return render_template('select_emails.html', records=search['records'], search=search, query=query,
+                           filters=filters, sendable_count=count_sendable_contacts(query, filters),
+                           sender_accounts=sender_pool.accounts.values(), account_usage=sender_pool.usage())
 
 @app.route('/generate-cv', methods=['GET', 'POST'])
 def standalone_cv():
@@ -131,11 +231,15 @@ def standalone_cv():
         role = request.form.get('role', 'Trading Assistant')
         
         try:
-            cv_path = generate_cv(role, app.config['OUTPUT_DIR'])
+            # Identical requests are served from the stored artifact without re-rendering
+            cv_path = cached_document(
+                document_key(*cv_context(role)), 'cv_download',
+                lambda directory: generate_cv(role, directory), app.config['OUTPUT_DIR']
+            )
             logger.info(f"Successfully generated standalone CV for role: {role}")
             
             # Return the file for download
-            return send_file(cv_path, as_attachment=True, download_name=f'CV - Justin Isambert.pdf')
+            return send_file(os.path.abspath(cv_path), as_attachment=True, download_name=f'CV - Justin Isambert.pdf')
         
         except Exception as e:
             logger.error(f"Error generating CV: {str(e)}")
@@ -160,14 +264,16 @@ def standalone_cover_letter():
         job = english_job if language == 'english' else french_job
         
         try:
-            cl_path = generate_cover_letter(
-                language, job, company, output_dir=app.config['OUTPUT_DIR'],
-                first_name=first_name, last_name=last_name, title=title, formality=formality
+            details = {'first_name': first_name, 'last_name': last_name, 'title': title, 'formality': formality}
+            cl_path = cached_document(
+                document_key(*cover_letter_context(language, job, company, **details)), 'cover_letter_download',
+                lambda directory: generate_cover_letter(language, job, company, output_dir=directory, **details),
+                app.config['OUTPUT_DIR']
             )
             logger.info(f"Successfully generated standalone cover letter for {company}, job: {job}")
             
             # Return the file for download
-            return send_file(cl_path, as_attachment=True, download_name=f'Cover Letter - Justin Isambert.pdf')
+            return send_file(os.path.abspath(cl_path), as_attachment=True, download_name=f'Cover Letter - Justin Isambert.pdf')
         
         except Exception as e:
             logger.error(f"Error generating cover letter: {str(e)}")
@@ -177,4 +283,8 @@ def standalone_cover_letter():
     return render_template('generate_cover_letter.html')
 
 if __name__ == '__main__':
+    # Development server; in production run gunicorn (or wsgi.py) and send_worker.py.
+    # With the reloader, only the child process serving requests runs the send worker.
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_in_thread(app.config['OUTPUT_DIR'], sender_pool)
     app.run(debug=True) 
\ No newline at end of file
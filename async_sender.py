@@ -0,0 +1,425 @@
+import os
+import asyncio
+import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from preflight import preflight
+from email_sender import extract_record_fields, skip_result, message_key, duplicate_result, render_email, OutlookTransport
+from database import claim_record, release_claim, begin_send, complete_send, fail_send
+from rate_limiter import RateLimiter, DEFAULT_RATE_PER_MINUTE
+from retry_scheduler import RetryPolicy, register_failure
+from storage import ensure_dir
+from domain_scheduler import record_domain, group_by_domain, DEFAULT_GROUP_SIZE, DEFAULT_WINDOW, DEFAULT_DOMAIN_CONCURRENCY
+
+# Setup logging
+logger = logging.getLogger(__name__)
+
+# Number of transport connections driven at once over SMTP; Outlook is driven by one worker
+DEFAULT_CONCURRENCY = 4
+
+# Word automation is not safe to drive from many threads, so renders are serialised by default
+DEFAULT_RENDER_WORKERS = 1
+
+# Warm per-domain connections each worker keeps open
+DEFAULT_IDLE_CONNECTIONS = 4
+
+# Threads resolving domains ahead of their first send, kept apart from the send threads
+PREFETCH_WORKERS = 2
+
+def _record_id(record):
+    try:
+        return record['id'] if record and 'id' in record.keys() else 'unknown'
+    except:
+        return 'unknown'
+
+def _assign_account(accounts, record):
+    """Pick the sender account of a record, see AccountPool.acquire"""
+    try:
+        fields = extract_record_fields(record)
+    except Exception:
+        # Left to _process_record to report
+        return None, None
+    if skip_result(fields):
+        return None, None
+    return accounts.acquire(fields)
+
+def _send_attempt(transport, fields, key, email_subject, email_body, attachments, policy):
+    """
+    Make one send attempt and record its outcome, in a send executor thread.
+
+    The send and its bookkeeping run in one call, so cancelling the batch
+    never leaves a message with the transport but missing from the ledger.
+    Transport and database errors count as failed attempts, like in
+    send_records.
+
+    Returns:
+    - (outcome, detail): ('retry', attempts) when the record should be sent
+      again, otherwise ('sent', result), ('skipped', result) or ('failed', result)
+    """
+    record_id = fields['id']
+    if not begin_send(key, record_id, fields['email']):
+        return 'skipped', duplicate_result(fields, key)
+
+    try:
+        email_sent = transport.send(fields['email'], email_subject, email_body, attachments)
+        error = "Failed to send email"
+    except Exception as e:
+        logger.error(f"Error sending record ID {record_id}: {str(e)}")
+        email_sent, error = False, f"Error sending email: {str(e)}"
+
+    if email_sent:
+        try:
+            complete_send(key, record_id)
+        except Exception as e:
+            # The message went out: never send it again. The ledger row stays
+            # 'sending', which start-up recovery reports for a manual check.
+            logger.error(f"Error recording the send of record ID {record_id}: {str(e)}")
+            return 'sent', {"id": record_id, "status": "error", "message": f"Email sent but not recorded: {str(e)}"}
+        logger.info(f"Successfully processed record ID: {record_id}")
+        return 'sent', {"id": record_id, "status": "success", "message": "Email sent successfully"}
+
+    try:
+        fail_send(key, error)
+        attempts, dead = register_failure(record_id, error, policy)
+    except Exception as e:
+        logger.error(f"Could not record the failure of record ID {record_id}: {str(e)}")
+        release_claim(record_id)
+        return 'failed', {"id": record_id, "status": "error", "message": error}
+
+    if dead:
+        logger.error(f"{error} for record ID: {record_id}, moved to dead letter")
+        return 'failed', {"id": record_id, "status": "error",
+                          "message": f"{error} after {attempts} attempts, moved to dead letter"}
+    return 'retry', attempts
+
+async def _process_record(record, output_dir, transport, limiter, policy, render, render_executor, send_executor,
+                          extra_limiters=(), release_quota=None):
+    """
+    Render and send one record on the given transport connection.
+
+    The record is claimed and every attempt goes through the send ledger,
+    like in send_records. Failed sends are retried with backoff on the
+    already rendered attachments. Returns the same result dictionary as
+    process_single_record.
+
+    extra_limiters (per domain, per sender account) pace every attempt on
+    top of the global limiter. release_quota is called when the record
+    turns out not to be sent, to give back its sender account quota.
+
+    When the batch is cancelled, an attempt already handed to the transport
+    is waited for, and a record left unsent goes back to pending.
+    """
+    loop = asyncio.get_running_loop()
+    release_quota = release_quota or (lambda: None)
+    record_id = _record_id(record)
+    claimed = False
+    in_flight = None
+
+    def settle(outcome, detail):
+        # Give back what a finished record did not use, None means try again
+        nonlocal claimed
+        if outcome == 'retry':
+            return None
+        claimed = False
+        if outcome != 'sent':
+            release_quota()
+        return detail
+
+    try:
+        fields = extract_record_fields(record)
+        record_id = fields['id']
+
+        skipped = skip_result(fields)
+        if skipped:
+            return skipped
+
+        if not await loop.run_in_executor(send_executor, claim_record, record_id):
+            release_quota()
+            logger.info(f"Skipping record ID: {record_id}, claimed by another batch")
+            return {"id": record_id, "status": "skipped", "message": "Already being sent"}
+        claimed = True
+
+        logger.info(f"Processing record ID: {record_id}, email: {fields['email']}")
+
+        # Each record renders into its own directory so concurrent jobs never share file names
+        record_dir = os.path.join(output_dir, str(record_id))
+        email_subject, email_body, attachments = await loop.run_in_executor(
+            render_executor, render, fields, record_dir
+        )
+
+        key = message_key(fields)
+        while True:
+            await limiter.acquire_async()
+            for extra_limiter in extra_limiters:
+                await extra_limiter.acquire_async()
+
+            in_flight = loop.run_in_executor(
+                send_executor, _send_attempt, transport, fields, key, email_subject, email_body, attachments, policy
+            )
+            outcome, detail = await asyncio.shield(in_flight)
+            in_flight = None
+
+            result = settle(outcome, detail)
+            if result:
+                return result
+
+            # Failures slow the limiter down so retries cannot spike the send rate
+            limiter.penalize()
+            for extra_limiter in extra_limiters:
+                extra_limiter.penalize()
+
+            delay = policy.delay(detail)
+            logger.warning(f"Failed to send email for record ID: {record_id}, retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+    except asyncio.CancelledError:
+        if in_flight is not None:
+            # The message is with the transport, its outcome decides what to give back
+            try:
+                settle(*await in_flight)
+            except Exception as e:
+                logger.error(f"Error finishing record ID {record_id}: {str(e)}")
+        if claimed:
+            release_claim(record_id)
+            release_quota()
+            logger.warning(f"Batch cancelled, record ID: {record_id} returned to pending")
+        raise
+    except Exception as e:
+        logger.error(f"Error processing record: {str(e)}")
+        if claimed:
+            release_claim(record_id)
+            release_quota()
+        return {"id": record_id, "status": "error", "message": str(e)}
+
+async def run_email_queue(records, output_dir='output', concurrency=None,
+                          transport_factory=OutlookTransport, rate_per_minute=DEFAULT_RATE_PER_MINUTE,
+                          render_workers=DEFAULT_RENDER_WORKERS, render=render_email, policy=None,
+                          group_by_domain_size=DEFAULT_GROUP_SIZE, domain_concurrency=DEFAULT_DOMAIN_CONCURRENCY,
+                          domain_rate_per_minute=None, domain_transport_factory=None, accounts=None, plans=None):
+    """
+    Process records with several transport connections working at once.
+
+    Records are grouped by sender account and recipient domain, and each
+    group is sent by one worker over one warm connection. Domains take
+    turns, and each domain has its own concurrency and rate caps.
+
+    Parameters:
+    - records: Iterable of database records to process
+    - output_dir: Directory to store generated files
+    - concurrency: Number of workers (DEFAULT_CONCURRENCY by default). Only
+      SMTP transports run more than one: a batch sending through Outlook
+      alone always uses one worker
+    - transport_factory: Callable returning an object with connect/send/close, one per worker
+    - rate_per_minute: Global send rate shared by all workers (None when the
+      sender accounts' own rates should be the only limit)
+    - render_workers: Threads used for the blocking render and PDF conversion
+    - render: Callable building (subject, body, attachments) from record fields
+      and a directory, and from the record's render plan when plans is given
+    - policy: RetryPolicy for backoff and dead-letter decisions
+    - group_by_domain_size: Records per domain group (0 keeps the input order)
+    - domain_concurrency: Groups of one domain sent at once
+    - domain_rate_per_minute: Send rate per domain (None for no per-domain limit)
+    - domain_transport_factory: Callable taking a domain and returning a transport,
+      used instead of transport_factory to connect to each domain separately
+      (benchmarks/bench_domains.py uses it with local stand-ins; real mail goes
+      through the configured relay or Outlook account)
+    - accounts: AccountPool spreading the records across sender accounts,
+      used instead of transport_factory
+    - plans: Dictionary of record ID to render plan, from the pre-flight check; each plan is removed once used
+
+    Returns:
+    - List of results for each record processed, in input order
+    """
+    if accounts and domain_transport_factory:
+        raise ValueError("Sender accounts send through their own transport, pass either accounts or domain_transport_factory")
+
+    # Ensure output directory exists
+    ensure_dir(output_dir)
+
+    if plans is not None:
+        render_with_plan = render
+
+        def render(fields, record_dir):
+            return render_with_plan(fields, record_dir, plans.pop(fields['id'], None))
+
+    # Outlook is a single COM instance, more workers would only queue on it
+    if domain_transport_factory:
+        outlook_only = False
+    elif accounts:
+        outlook_only = all(account.transport == 'outlook' for account in accounts.accounts.values())
+    else:
+        outlook_only = transport_factory is OutlookTransport
+    if outlook_only:
+        if concurrency and int(concurrency) > 1:
+            logger.warning(f"Outlook sends one message at a time, using 1 worker instead of {concurrency}")
+        concurrency = 1
+    concurrency = max(1, int(concurrency or DEFAULT_CONCURRENCY))
+    limiter = RateLimiter(rate_per_minute)
+    policy = policy or RetryPolicy()
+    render_executor = ThreadPoolExecutor(max_workers=render_workers, thread_name_prefix='render')
+    send_executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='send')
+    loop = asyncio.get_running_loop()
+
+    # A bounded queue keeps memory flat even when records is a large cursor
+    queue = asyncio.Queue(maxsize=concurrency * 2)
+    results = {}
+    # Sender account of each record counted against a quota but not started yet
+    reserved = {}
+    transports = []
+    domain_slots = {}
+    domain_limiters = {}
+
+    def domain_caps(domain):
+        if domain not in domain_slots:
+            domain_slots[domain] = asyncio.Semaphore(max(1, int(domain_concurrency)))
+            domain_limiters[domain] = RateLimiter(domain_rate_per_minute) if domain_rate_per_minute else None
+        return domain_slots[domain], domain_limiters[domain]
+
+    async def close_transport(transport):
+        try:
+            await loop.run_in_executor(send_executor, transport.close)
+        except Exception as e:
+            logger.error(f"Error closing transport: {str(e)}")
+
+    async def worker():
+        # Warm connections of this worker, least recently used first
+        warm = OrderedDict()
+
+        async def transport_for(account, domain):
+            if account:
+                key, factory = account.name, account.make_transport
+            elif domain_transport_factory:
+                key, factory = domain, lambda: domain_transport_factory(domain)
+            else:
+                key, factory = None, transport_factory
+
+            if key in warm:
+                warm.move_to_end(key)
+                return warm[key]
+            transport = await loop.run_in_executor(send_executor, factory)
+            transports.append(transport)
+            warm[key] = transport
+            if len(warm) > DEFAULT_IDLE_CONNECTIONS:
+                _, evicted = warm.popitem(last=False)
+                transports.remove(evicted)
+                await close_transport(evicted)
+            return transport
+
+        while True:
+            item = await queue.get()
+            try:
+                if item is None:
+                    return
+                (account, domain), group = item
+                slot, domain_limiter = domain_caps(domain)
+                extra_limiters = [found for found in (domain_limiter, account and account.limiter) if found]
+                release_quota = (lambda: accounts.release(account)) if account else None
+
+                async with slot:
+                    try:
+                        transport = await transport_for(account, domain)
+                    except Exception as e:
+                        logger.error(f"No transport for domain {domain}: {str(e)}")
+                        for index, record in group:
+                            if reserved.pop(index, None):
+                                release_quota()
+                            results[index] = {"id": _record_id(record), "status": "error", "message": str(e)}
+                        continue
+
+                    for index, record in group:
+                        # From here on the record gives back its own quota
+                        reserved.pop(index, None)
+                        results[index] = await _process_record(
+                            record, output_dir, transport, limiter, policy, render, render_executor, send_executor,
+                            extra_limiters, release_quota
+                        )
+            finally:
+                queue.task_done()
+
+    def assigned(items):
+        # Assignment is a couple of quick statements, run inline like the cursor reads
+        for index, record in items:
+            account = None
+            if accounts:
+                account, reason = _assign_account(accounts, record)
+                if reason:
+                    logger.info(f"Deferring record ID: {_record_id(record)}, {reason}")
+                    results[index] = {"id": _record_id(record), "status": "skipped", "message": reason}
+                    continue
+                reserved[index] = account
+            yield (account, record_domain(record)), (index, record)
+
+    def group_key(entry):
+        return entry[0]
+
+    workers = [asyncio.ensure_future(worker()) for _ in range(concurrency)]
+    prefetch = getattr(domain_transport_factory, 'prefetch', None)
+    prefetch_executor = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix='prefetch') if prefetch else None
+    prefetches = []
+    seen_domains = set()
+
+    def prefetch_quietly(domain):
+        # A failed lookup is retried, and reported, by the first send to the domain
+        try:
+            prefetch(domain)
+        except Exception as e:
+            logger.debug(f"Prefetch of {domain} failed: {str(e)}")
+
+    try:
+        entries = assigned(enumerate(records))
+        if group_by_domain_size:
+            groups = group_by_domain(entries, group_key, group_by_domain_size, DEFAULT_WINDOW)
+        else:
+            groups = ((group_key(entry), [entry]) for entry in entries)
+
+        for key, group in groups:
+            domain = key[1]
+            # Resolve new domains in the background while earlier groups are sent
+            if prefetch and domain not in seen_domains:
+                seen_domains.add(domain)
+                prefetches.append(loop.run_in_executor(prefetch_executor, prefetch_quietly, domain))
+            await queue.put((key, [entry[1] for entry in group]))
+        for _ in workers:
+            await queue.put(None)
+        await asyncio.gather(*workers)
+
+    finally:
+        # On cancellation stop the workers before tearing down what they use
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+        # Lookups nobody needs any more are dropped rather than waited for
+        for future in prefetches:
+            future.cancel()
+        if prefetch_executor:
+            prefetch_executor.shutdown(wait=False, cancel_futures=True)
+
+        # Records still queued or grouped were never started, give back their quota
+        for account in reserved.values():
+            accounts.release(account)
+
+        # Sends and renders still running finish before their connections are closed
+        await loop.run_in_executor(None, send_executor.shutdown)
+        await loop.run_in_executor(None, render_executor.shutdown)
+
+        for transport in transports:
+            try:
+                transport.close()
+            except Exception as e:
+                logger.error(f"Error closing transport: {str(e)}")
+
+    return [results[index] for index in sorted(results)]
+
+def process_email_queue_async(records, output_dir='output', **options):
+    """
+    Drop-in alternative to process_email_queue driven by the asyncio engine.
+
+    Runs the same pre-flight check first, so rows that cannot be sent are
+    reported before anything is rendered. Accepts the keyword options of
+    run_email_queue and returns the same list of result dictionaries as
+    process_email_queue.
+    """
+    report = preflight(records)
+    results = asyncio.run(run_email_queue(report['records'], output_dir, plans=report['plans'], **options))
+    return report['invalid'] + results
@@ -0,0 +1,68 @@
+"""
+Throughput of the asyncio sending engine against a local SMTP stand-in.
+
+Rendering is replaced by a fixed attachment so only the send path is
+measured. The database lives in a temporary directory.
+
+Usage:
+    python benchmarks/bench_async_send.py --records 200 --latency 0.05 --concurrency 1 2 4 8
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from smtp_standin import SmtpStandIn
+from smtp_transport import SmtpTransport
+from async_sender import run_email_queue
+from database import init_db, get_all_records, get_db_connection
+from fixtures import seed_contacts
+
+def make_fake_render(attachment):
+    def render(fields, output_dir):
+        return f"Application {fields['english_job']}", f"Dear {fields['company']}", [attachment]
+    return render
+
+def run(records, latency, concurrency_levels, rate_per_minute):
+    workdir = tempfile.mkdtemp(prefix='bench_async_')
+    os.chdir(workdir)
+    init_db()
+
+    attachment = os.path.join(workdir, 'attachment.pdf')
+    with open(attachment, 'wb') as file:
+        file.write(b'%PDF-1.4\n' + b'0' * 50000)
+
+    print(f"{'concurrency':>12} {'records':>8} {'seconds':>8} {'msg/s':>8}")
+    with SmtpStandIn(latency=latency) as server:
+        for concurrency in concurrency_levels:
+            # Fresh pending rows for every run
+            conn = get_db_connection()
+            conn.execute('DELETE FROM contacts')
+            conn.commit()
+            conn.close()
+            seed_contacts(records, processed_share=0)
+
+            start = time.perf_counter()
+            results = asyncio.run(run_email_queue(
+                get_all_records(), output_dir=os.path.join(workdir, 'output'),
+                concurrency=concurrency,
+                transport_factory=lambda: SmtpTransport(host='127.0.0.1', port=server.port),
+                rate_per_minute=rate_per_minute, render=make_fake_render(attachment)
+            ))
+            elapsed = time.perf_counter() - start
+
+            sent = sum(1 for r in results if r['status'] == 'success')
+            print(f"{concurrency:>12} {sent:>8} {elapsed:>8.2f} {sent / elapsed:>8.1f}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--records', type=int, default=200)
+    parser.add_argument('--latency', type=float, default=0.05, help='Stand-in latency per message (s)')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--rate', type=float, default=None, help='Send rate per minute (default: unlimited)')
+    args = parser.parse_args()
+    run(args.records, args.latency, args.concurrency, args.rate)
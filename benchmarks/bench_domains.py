@@ -0,0 +1,91 @@
+"""
+Effect of recipient-domain grouping when every domain has its own server.
+
+Every recipient domain is resolved through a local DNS stand-in to a local
+SMTP stand-in, so each domain gets its own connection. This only exercises
+the scheduler and MxCache: real mail goes through the configured relay or
+Outlook account, since direct delivery from an institutional address fails
+SPF/DMARC checks and port 25 is usually blocked. Runs are compared with and without grouping, and the report
+shows SMTP connections opened, DNS queries sent and messages per second.
+
+Usage:
+    python benchmarks/bench_domains.py --records 500 --concurrency 4
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from smtp_standin import SmtpStandIn
+from dns_standin import DnsStandIn
+from smtp_transport import SmtpTransport
+from mx_resolver import MxCache, query_mx
+from async_sender import run_email_queue
+from database import init_db, get_all_records, get_db_connection
+from fixtures import seed_contacts
+from bench_async_send import make_fake_render
+
+class StandInMxFactory:
+    """Transport factory connecting each domain to the SMTP stand-in its MX record points at"""
+
+    def __init__(self, mx_cache, port):
+        self.mx_cache = mx_cache
+        self.port = port
+
+    def prefetch(self, domain):
+        return self.mx_cache.resolve(domain)
+
+    def __call__(self, domain):
+        hosts = self.mx_cache.resolve(domain)
+        if not hosts:
+            raise ValueError(f"No mail exchanger found for {domain}")
+        return SmtpTransport(host=hosts[0], port=self.port)
+
+def run(records, latency, concurrency, group_sizes, domain_concurrency):
+    workdir = tempfile.mkdtemp(prefix='bench_domains_')
+    os.chdir(workdir)
+    init_db()
+
+    attachment = os.path.join(workdir, 'attachment.pdf')
+    with open(attachment, 'wb') as file:
+        file.write(b'%PDF-1.4\n' + b'0' * 50000)
+
+    print(f"{'group size':>10} {'records':>8} {'seconds':>8} {'msg/s':>8} {'connections':>12} {'dns queries':>12}")
+    with SmtpStandIn(latency=latency) as server, DnsStandIn() as dns_server:
+        for group_size in group_sizes:
+            # Fresh pending rows for every run
+            conn = get_db_connection()
+            conn.execute('DELETE FROM contacts')
+            conn.commit()
+            conn.close()
+            seed_contacts(records, processed_share=0)
+
+            connections, queries = server.connections, dns_server.queries
+            mx_cache = MxCache(resolver=lambda domain: query_mx(domain, nameserver=dns_server.address))
+            start = time.perf_counter()
+            results = asyncio.run(run_email_queue(
+                get_all_records(), output_dir=os.path.join(workdir, 'output'),
+                concurrency=concurrency, rate_per_minute=None, render=make_fake_render(attachment),
+                group_by_domain_size=group_size, domain_concurrency=domain_concurrency,
+                domain_transport_factory=StandInMxFactory(mx_cache, server.port)
+            ))
+            elapsed = time.perf_counter() - start
+
+            sent = sum(1 for r in results if r['status'] == 'success')
+            print(f"{group_size or 'off':>10} {sent:>8} {elapsed:>8.2f} {sent / elapsed:>8.1f} "
+                  f"{server.connections - connections:>12} {dns_server.queries - queries:>12}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--records', type=int, default=500)
+    parser.add_argument('--latency', type=float, default=0.01, help='Stand-in latency per message (s)')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--group-sizes', type=int, nargs='+', default=[0, 5, 20],
+                        help='Records per domain group to compare, 0 disables grouping')
+    parser.add_argument('--domain-concurrency', type=int, default=2)
+    args = parser.parse_args()
+    run(args.records, args.latency, args.concurrency, args.group_sizes, args.domain_concurrency)
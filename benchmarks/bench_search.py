@@ -0,0 +1,57 @@
+"""
+Latency of search_contacts on a synthetic contacts table.
+
+The database lives in a temporary directory.
+
+Usage:
+    python benchmarks/bench_search.py --contacts 100000 --runs 200
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import init_db, search_contacts
+from fixtures import seed_contacts
+
+QUERIES = [
+    ('', {}),
+    ('', {'language': 'french', 'processed': '0'}),
+    ('bnp', {}),
+    ('soc', {'language': 'french', 'processed': '0'}),
+    ('company:deut', {'formality': 'formal'}),
+    ('marie dub', {}),
+    ('quant', {'role': 'Quant Analyst'}),
+]
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))]
+
+def run(contacts, runs):
+    os.chdir(tempfile.mkdtemp(prefix='bench_search_'))
+    init_db()
+
+    start = time.perf_counter()
+    seed_contacts(contacts)
+    print(f"Seeded {contacts} contacts in {time.perf_counter() - start:.1f}s")
+
+    print(f"{'query':<28} {'filters':<40} {'hits':>7} {'p50 ms':>8} {'p95 ms':>8}")
+    for query, filters in QUERIES:
+        timings = []
+        for i in range(runs):
+            start = time.perf_counter()
+            result = search_contacts(query, filters, page=1 + i % 5, per_page=50)
+            timings.append((time.perf_counter() - start) * 1000)
+        print(f"{query or '-':<28} {str(filters):<40} {result['total']:>7} "
+              f"{percentile(timings, 50):>8.2f} {percentile(timings, 95):>8.2f}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--contacts', type=int, default=100000)
+    parser.add_argument('--runs', type=int, default=200)
+    args = parser.parse_args()
+    run(args.contacts, args.runs)
@@ -0,0 +1,113 @@
+import socket
+import struct
+import threading
+import logging
+
+# Setup logging
+logger = logging.getLogger(__name__)
+
+# DNS record types and flags used by the stand-in
+TYPE_MX = 15
+CLASS_IN = 1
+FLAGS_ANSWER = 0x8180
+FLAGS_NXDOMAIN = 0x8183
+
+def encode_name(name):
+    return b''.join(bytes([len(label)]) + label.encode('ascii') for label in name.rstrip('.').split('.') if label) + b'\0'
+
+class DnsStandIn:
+    """
+    Minimal local DNS server answering MX queries, a stand-in for real DNS.
+
+    Every domain resolves to one mail exchanger (localhost by default),
+    so direct-to-MX delivery can be pointed at SmtpStandIn. Point
+    mx_resolver at it with DNS_SERVER=127.0.0.1:<port> or
+    query_mx(domain, nameserver=...). The server counts the queries it
+    answered, which shows how well MxCache works.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, exchange='localhost', mapping=None, ttl=3600):
+        """
+        Parameters:
+        - host, port: Address to listen on (port 0 picks a free port)
+        - exchange: Mail exchanger returned for every domain
+        - mapping: Optional dictionary of domain to mail exchanger, other domains get NXDOMAIN
+        - ttl: TTL of the answers
+        """
+        self.host = host
+        self.port = port
+        self.exchange = exchange
+        self.mapping = mapping
+        self.ttl = ttl
+        self.queries = 0
+        self._socket = None
+        self._thread = None
+        self._stop_event = threading.Event()
+
+    def _answer(self, query):
+        request_id = struct.unpack('>H', query[:2])[0]
+
+        # Walk the question name to find where it ends
+        offset = 12
+        labels = []
+        while query[offset]:
+            length = query[offset]
+            labels.append(query[offset + 1:offset + 1 + length].decode('ascii'))
+            offset += 1 + length
+        qtype, _ = struct.unpack('>HH', query[offset + 1:offset + 5])
+        question = query[12:offset + 5]
+        domain = '.'.join(labels).lower()
+
+        exchange = self.mapping.get(domain) if self.mapping is not None else self.exchange
+        if exchange is None:
+            return struct.pack('>HHHHHH', request_id, FLAGS_NXDOMAIN, 1, 0, 0, 0) + question
+
+        answers = b''
+        if qtype == TYPE_MX:
+            rdata = struct.pack('>H', 10) + encode_name(exchange)
+            # 0xC00C points back to the name in the question
+            answers = struct.pack('>HHHIH', 0xC00C, TYPE_MX, CLASS_IN, self.ttl, len(rdata)) + rdata
+        return struct.pack('>HHHHHH', request_id, FLAGS_ANSWER, 1, 1 if answers else 0, 0, 0) + question + answers
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            try:
+                query, address = self._socket.recvfrom(512)
+            except socket.timeout:
+                continue
+            try:
+                self.queries += 1
+                self._socket.sendto(self._answer(query), address)
+            except Exception as e:
+                logger.warning(f"DNS stand-in could not answer a query: {str(e)}")
+
+    def start(self):
+        """Start the server and return the port it listens on"""
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.bind((self.host, self.port))
+        self.port = self._socket.getsockname()[1]
+        # Wake up regularly to notice stop()
+        self._socket.settimeout(0.2)
+        self._thread = threading.Thread(target=self._run, name='dns-standin', daemon=True)
+        self._thread.start()
+        logger.info(f"DNS stand-in listening on {self.host}:{self.port}")
+        return self.port
+
+    @property
+    def address(self):
+        """Name server address in the host:port form used by mx_resolver"""
+        return f"{self.host}:{self.port}"
+
+    def stop(self):
+        """Stop the server and wait for its thread"""
+        if self._socket is not None:
+            self._stop_event.set()
+            self._thread.join()
+            self._socket.close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
@@ -0,0 +1,40 @@
+"""
+Synthetic data shared by the benchmarks.
+"""
+import random
+from database import get_db_connection
+
+COMPANIES = ['BNP Paribas', 'Societe Generale', 'Natixis', 'Credit Agricole', 'Goldman Sachs',
+             'JP Morgan', 'Morgan Stanley', 'Barclays', 'HSBC', 'Deutsche Bank', 'UBS', 'Citi']
+FIRST_NAMES = ['Alice', 'Bruno', 'Claire', 'David', 'Emma', 'Louis', 'Marie', 'Paul', 'Sophie', 'Thomas']
+LAST_NAMES = ['Martin', 'Bernard', 'Dubois', 'Durand', 'Leroy', 'Moreau', 'Simon', 'Laurent', 'Smith', 'Brown']
+ROLES = ['Trading Assistant', 'Quant Analyst', 'Sales Assistant', 'Structurer']
+
+def seed_contacts(count, seed=0, processed_share=0.3):
+    """
+    Bulk insert synthetic contacts into the current database.
+
+    Rows are generated lazily so seeding large sizes does not inflate memory.
+    """
+    rng = random.Random(seed)
+
+    def rows():
+        for i in range(count):
+            company = f"{rng.choice(COMPANIES)} {i % 997}"
+            first_name, last_name = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+            role = rng.choice(ROLES)
+            yield (f"{first_name.lower()}.{last_name.lower()}{i}@{company.split()[0].lower()}.com",
+                   role, role, company, first_name, last_name, rng.choice(['Mr.', 'Ms.', '']),
+                   rng.choice(['formal', 'semi-formal', 'informal']), role,
+                   rng.choice(['english', 'french']), rng.choice(['english', 'french']),
+                   1 if rng.random() < processed_share else 0)
+
+    conn = get_db_connection()
+    conn.executemany('''
+    INSERT INTO contacts (email, english_job, french_job, company, first_name, last_name, title, formality, role, cover_letter_language, email_language, processed)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', rows())
+    # Keep state consistent with the processed flag
+    conn.execute("UPDATE contacts SET state = 'sent' WHERE processed = 1")
+    conn.commit()
+    conn.close()
@@ -0,0 +1,396 @@
+"""
+End-to-end benchmark of the send pipeline.
+
+Seeds a fresh email_data.db with synthetic contacts in a temporary
+directory, then runs process_email_queue and/or send_selected_emails with a
+fake or real converter and transport. Reports records per second,
+per-stage latency percentiles, peak RSS and peak open file handles, and
+stores the results as JSON so runs can be compared across versions.
+
+Usage:
+    python benchmarks/harness.py --size 100
+    python benchmarks/harness.py --converter sample-pdf --optimize-pdf
+    python benchmarks/harness.py --converter word --transport outlook --profile
+    python benchmarks/harness.py --size 10k --transport smtp --output before.json
+    python benchmarks/harness.py --size 10k --compare before.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import logging
+import shutil
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import email_sender
+import document_processor
+import pdf_optimizer
+from database import init_db, get_all_records, iter_sendable_contacts
+from rate_limiter import RateLimiter
+from retry_scheduler import RetryPolicy
+from smtp_transport import SmtpTransport
+from smtp_standin import SmtpStandIn
+from profiling import SamplingProfiler
+from fixtures import seed_contacts
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# Preset contact counts
+PRESETS = {'100': 100, '10k': 10000, '100k': 100000}
+
+DRIVERS = ('queue', 'selected')
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))]
+
+class StageTimings:
+    """Collects call durations per pipeline stage"""
+
+    def __init__(self):
+        self.durations = {}
+
+    def wrap(self, stage, func):
+        durations = self.durations.setdefault(stage, [])
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                durations.append(time.perf_counter() - start)
+        return timed
+
+    def summary(self):
+        summary = {}
+        for stage, durations in self.durations.items():
+            if not durations:
+                continue
+            summary[stage] = {
+                'count': len(durations),
+                'mean_ms': sum(durations) / len(durations) * 1000,
+                'p50_ms': percentile(durations, 50) * 1000,
+                'p95_ms': percentile(durations, 95) * 1000,
+                'p99_ms': percentile(durations, 99) * 1000,
+                'max_ms': max(durations) * 1000,
+            }
+        return summary
+
+def current_rss():
+    """Resident set size of this process in bytes, or None"""
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    if os.path.exists('/proc/self/statm'):
+        with open('/proc/self/statm') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    return None
+
+def open_handles():
+    """Number of open file descriptors (handles on Windows), or None"""
+    if psutil is not None:
+        process = psutil.Process()
+        return process.num_handles() if hasattr(process, 'num_handles') else process.num_fds()
+    if os.path.isdir('/proc/self/fd'):
+        return len(os.listdir('/proc/self/fd'))
+    return None
+
+class ResourceSampler(threading.Thread):
+    """Samples RSS and open handles in the background and keeps the peaks"""
+
+    def __init__(self, interval=0.05):
+        super().__init__(name='resource-sampler', daemon=True)
+        self.interval = interval
+        self.peak_rss = 0
+        self.peak_handles = 0
+        self._stop_event = threading.Event()
+
+    def sample(self):
+        self.peak_rss = max(self.peak_rss, current_rss() or 0)
+        self.peak_handles = max(self.peak_handles, open_handles() or 0)
+
+    def run(self):
+        while not self._stop_event.is_set():
+            self.sample()
+            self._stop_event.wait(self.interval)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        self.sample()
+
+class FakeTransport:
+    """Transport that reads the attachments, waits a fixed latency and accepts the message"""
+
+    def __init__(self, latency=0.0, failure_rate=0.0, seed=0):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.bytes_sent = 0
+        self._rng = random.Random(seed)
+
+    def send(self, to_email, subject, body, attachments=None):
+        for attachment in attachments or []:
+            with open(attachment, 'rb') as file:
+                self.bytes_sent += len(file.read())
+        if self.latency:
+            time.sleep(self.latency)
+        return self._rng.random() >= self.failure_rate
+
+def make_fake_converter(latency=0.0):
+    """Converter that copies the rendered docx instead of driving Word"""
+    def convert(docx_path, pdf_path):
+        if latency:
+            time.sleep(latency)
+        shutil.copyfile(docx_path, pdf_path)
+    return convert
+
+def make_sample_pdf_converter(latency=0.0):
+    """
+    Converter writing a PDF with a full embedded font and an uncompressed
+    photo, the kind of output Word produces, so --optimize-pdf has
+    something to work on. Requires reportlab and Pillow.
+    """
+    from reportlab.pdfgen import canvas
+    from reportlab.pdfbase import pdfmetrics
+    from reportlab.pdfbase.ttfonts import TTFont
+    from reportlab.lib.utils import ImageReader
+    from PIL import Image
+
+    font_path = next((path for path in SAMPLE_FONTS if os.path.exists(path)), None)
+    if font_path:
+        pdfmetrics.registerFont(TTFont('SampleFont', font_path))
+    photo = Image.merge('RGB', [
+        Image.linear_gradient('L').resize((2400, 1600)),
+        Image.effect_noise((2400, 1600), 30),
+        Image.linear_gradient('L').rotate(90).resize((2400, 1600)),
+    ])
+
+    # reportlab is slow at encoding large images, so the sample is built once
+    sample_pdf = os.path.join(tempfile.mkdtemp(prefix='sample_pdf_'), 'sample.pdf')
+    pdf = canvas.Canvas(sample_pdf, pageCompression=0)
+    pdf.setFont('SampleFont' if font_path else 'Helvetica', 11)
+    pdf.drawString(72, 770, 'Sample document')
+    pdf.drawImage(ImageReader(photo), 72, 300, width=450, height=300)
+    pdf.save()
+
+    def convert(docx_path, pdf_path):
+        if latency:
+            time.sleep(latency)
+        shutil.copyfile(sample_pdf, pdf_path)
+    return convert
+
+# Fonts embedded by the sample converter, the first one found is used
+SAMPLE_FONTS = (
+    '/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf',
+    'C:\\Windows\\Fonts\\arial.ttf',
+    '/Library/Fonts/Arial.ttf',
+)
+
+def git_version():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except Exception:
+        return 'unknown'
+
+def run_driver(driver, size, args, smtp_port=None):
+    """Run one driver on a freshly seeded database and return its measurements"""
+    workdir = tempfile.mkdtemp(prefix=f'harness_{driver}_')
+    # Templates are read from the working directory, like in the app
+    shutil.copytree(os.path.join(ROOT, 'templates'), os.path.join(workdir, 'templates'))
+    os.chdir(workdir)
+    init_db()
+    seed_contacts(size, processed_share=0)
+
+    timings = StageTimings()
+    if args.converter == 'fake':
+        converter = make_fake_converter(args.convert_latency)
+    elif args.converter == 'sample-pdf':
+        converter = make_sample_pdf_converter(args.convert_latency)
+    else:
+        converter = document_processor.word_converter
+
+    if args.transport == 'fake':
+        transport = FakeTransport(args.send_latency, args.failure_rate)
+    elif args.transport == 'smtp':
+        transport = SmtpTransport(host='127.0.0.1', port=smtp_port)
+    else:
+        transport = email_sender.OutlookTransport()
+
+    # Instrument the pipeline stages
+    patched = {name: getattr(email_sender, name) for name in ('render_email', 'claim_record', 'complete_send')}
+    email_sender.render_email = timings.wrap('render', patched['render_email'])
+    email_sender.claim_record = timings.wrap('claim', patched['claim_record'])
+    email_sender.complete_send = timings.wrap('complete', patched['complete_send'])
+    previous_converter = document_processor.set_converter(timings.wrap('convert', converter))
+    previous_optimize = pdf_optimizer.PDF_OPTIMIZE
+    optimize_pdf = pdf_optimizer.optimize_pdf
+    pdf_optimizer.PDF_OPTIMIZE = args.optimize_pdf
+    pdf_optimizer.optimize_pdf = timings.wrap('optimize', optimize_pdf)
+    pdf_stats = dict(pdf_optimizer.stats)
+
+    options = {
+        'send': timings.wrap('send', transport.send),
+        'limiter': RateLimiter(args.rate),
+        'policy': RetryPolicy(base_delay=args.retry_delay, max_delay=args.retry_delay * 8),
+    }
+
+    sampler = ResourceSampler()
+    sampler.start()
+    profiler = None
+    if args.profile:
+        profiler = SamplingProfiler(f'harness-{driver}-{size}', thread_ids={threading.get_ident()},
+                                    output_dir=os.path.join(ROOT, 'benchmarks', 'results')).start()
+    start = time.perf_counter()
+    try:
+        if driver == 'queue':
+            results = email_sender.process_email_queue(get_all_records(), 'output', **options)
+        else:
+            results = email_sender.send_selected_emails(iter_sendable_contacts, 'output', **options)
+    finally:
+        elapsed = time.perf_counter() - start
+        flamegraph = profiler.stop() if profiler else None
+        sampler.stop()
+        for name, func in patched.items():
+            setattr(email_sender, name, func)
+        document_processor.set_converter(previous_converter)
+        pdf_optimizer.PDF_OPTIMIZE = previous_optimize
+        pdf_optimizer.optimize_pdf = optimize_pdf
+        if hasattr(transport, 'close'):
+            transport.close()
+        os.chdir(ROOT)
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    statuses = {}
+    for result in results:
+        statuses[result['status']] = statuses.get(result['status'], 0) + 1
+
+    pdf_stats = {key: pdf_optimizer.stats[key] - value for key, value in pdf_stats.items()}
+    bytes_sent = getattr(transport, 'bytes_sent', None)
+
+    return {
+        'records': len(results),
+        'statuses': statuses,
+        'seconds': elapsed,
+        'records_per_second': len(results) / elapsed if elapsed else 0.0,
+        'stages': timings.summary(),
+        'peak_rss_mb': sampler.peak_rss / (1024 * 1024),
+        'peak_open_handles': sampler.peak_handles,
+        'bytes_sent': bytes_sent,
+        'bytes_sent_per_record': bytes_sent / len(results) if bytes_sent is not None and results else None,
+        'pdf': pdf_stats,
+        'flamegraph': flamegraph,
+    }
+
+def print_report(report):
+    print(f"\nVersion {report['version']}, {report['size']} contacts, "
+          f"converter={report['config']['converter']}, transport={report['config']['transport']}")
+    for driver, result in report['drivers'].items():
+        print(f"\n[{driver}] {result['records']} records in {result['seconds']:.2f}s "
+              f"({result['records_per_second']:.1f}/s), statuses {result['statuses']}")
+        print(f"  peak RSS {result['peak_rss_mb']:.1f} MB, peak open handles {result['peak_open_handles']}")
+        if result['bytes_sent'] is not None:
+            print(f"  attachments sent {result['bytes_sent'] / 1024:.1f} KB "
+                  f"({result['bytes_sent_per_record'] / 1024:.1f} KB per record)")
+        if result['pdf']['documents']:
+            pdf = result['pdf']
+            print(f"  PDFs {pdf['documents']} ({pdf['cache_hits']} from cache), "
+                  f"{pdf['bytes_before'] / 1024:.1f} KB -> {pdf['bytes_after'] / 1024:.1f} KB")
+        if result.get('flamegraph'):
+            print(f"  flamegraph {result['flamegraph']}")
+        print(f"  {'stage':<10} {'count':>7} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+        for stage, stats in result['stages'].items():
+            print(f"  {stage:<10} {stats['count']:>7} {stats['p50_ms']:>9.2f} {stats['p95_ms']:>9.2f} "
+                  f"{stats['p99_ms']:>9.2f} {stats['max_ms']:>9.2f}")
+
+def print_comparison(report, baseline):
+    def change(new, old):
+        return f"{(new - old) / old * 100:+.1f}%" if old else 'n/a'
+
+    print(f"\nComparison with {baseline['version']} ({baseline['timestamp']})")
+    for driver, result in report['drivers'].items():
+        old = baseline.get('drivers', {}).get(driver)
+        if not old:
+            continue
+        print(f"[{driver}] records/s {old['records_per_second']:.1f} -> {result['records_per_second']:.1f} "
+              f"({change(result['records_per_second'], old['records_per_second'])}), "
+              f"peak RSS {old['peak_rss_mb']:.1f} -> {result['peak_rss_mb']:.1f} MB")
+        if result.get('bytes_sent') is not None and old.get('bytes_sent'):
+            print(f"  bytes sent {old['bytes_sent']} -> {result['bytes_sent']} "
+                  f"({change(result['bytes_sent'], old['bytes_sent'])})")
+        for stage, stats in result['stages'].items():
+            if stage in old['stages']:
+                old_p95 = old['stages'][stage]['p95_ms']
+                print(f"  {stage:<10} p95 {old_p95:.2f} -> {stats['p95_ms']:.2f} ms ({change(stats['p95_ms'], old_p95)})")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', default='100', help=f"Contacts to seed: {', '.join(PRESETS)} or a number")
+    parser.add_argument('--driver', choices=DRIVERS + ('both',), default='both')
+    parser.add_argument('--converter', choices=('fake', 'sample-pdf', 'word'), default='fake')
+    parser.add_argument('--transport', choices=('fake', 'smtp', 'outlook'), default='fake')
+    parser.add_argument('--convert-latency', type=float, default=0.0, help='Fake converter delay per document (s)')
+    parser.add_argument('--send-latency', type=float, default=0.0, help='Fake transport or SMTP stand-in delay (s)')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='Share of fake sends that fail')
+    parser.add_argument('--retry-delay', type=float, default=0.01, help='Base retry delay (s)')
+    parser.add_argument('--optimize-pdf', action='store_true', help='Enable PDF optimization and its cache')
+    parser.add_argument('--rate', type=float, default=None, help='Send rate per minute (default: unlimited)')
+    parser.add_argument('--output', help='JSON results file (default: benchmarks/results/<version>-<size>.json)')
+    parser.add_argument('--compare', help='Earlier JSON results file to compare against')
+    parser.add_argument('--profile', action='store_true',
+                        help='Sample the run and write a flamegraph next to the results')
+    parser.add_argument('--keep', action='store_true', help='Keep the temporary working directories')
+    parser.add_argument('--log-level', default='ERROR', help='Logging level of the application modules')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.log_level.upper(), format='%(asctime)s - %(levelname)s - %(name)s - %(message)s')
+
+    size = PRESETS.get(args.size) or int(args.size)
+    drivers = DRIVERS if args.driver == 'both' else (args.driver,)
+
+    report = {
+        'version': git_version(),
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'size': size,
+        'config': {key: value for key, value in vars(args).items() if key not in ('output', 'compare', 'log_level')},
+        'drivers': {},
+    }
+
+    server = SmtpStandIn(latency=args.send_latency) if args.transport == 'smtp' else None
+    if server:
+        server.start()
+    try:
+        for driver in drivers:
+            report['drivers'][driver] = run_driver(driver, size, args, server.port if server else None)
+    finally:
+        if server:
+            server.stop()
+
+    print_report(report)
+
+    output = args.output or os.path.join(ROOT, 'benchmarks', 'results', f"{report['version']}-{size}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as file:
+        json.dump(report, file, indent=2)
+    print(f"\nResults written to {output}")
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as file:
+            print_comparison(report, json.load(file))
+
+if __name__ == '__main__':
+    main()
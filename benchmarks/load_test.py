@@ -0,0 +1,132 @@
+"""
+Load test of the web server at a target request rate.
+
+Requests are started on a fixed schedule (open loop), so a slow server
+shows up as latency instead of quietly lowering the rate. Latency is
+measured from the scheduled start, which includes time spent waiting for a
+client thread. Reports the achieved rate, latency percentiles and errors.
+
+With --serve, gunicorn is started with gunicorn.conf.py on a fresh
+database of synthetic contacts in a temporary directory; otherwise --url
+points at a running server.
+
+Usage:
+    python benchmarks/load_test.py --serve 10000 --rate 200 --duration 30
+    python benchmarks/load_test.py --url http://127.0.0.1:8000 --rate 50
+"""
+import os
+import sys
+import time
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from harness import percentile
+
+DEFAULT_PATHS = ['/', '/api/search?q=bnp', '/api/search?language=french&page=2', '/select-emails']
+
+def fetch(url, timeout):
+    """Return the status code of a GET request"""
+    try:
+        with urllib.request.urlopen(url, timeout=timeout) as response:
+            response.read()
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+    except Exception:
+        return None
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def start_server(contacts, workers):
+    """Start gunicorn on a seeded database and return (process, base URL)"""
+    workdir = tempfile.mkdtemp(prefix='load_test_')
+    os.chdir(workdir)
+    from database import init_db
+    from fixtures import seed_contacts
+    init_db()
+    seed_contacts(contacts)
+
+    port = free_port()
+    env = dict(os.environ, BIND=f'127.0.0.1:{port}', PYTHONPATH=ROOT)
+    if workers:
+        env['WEB_WORKERS'] = str(workers)
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', os.path.join(ROOT, 'gunicorn.conf.py'), 'wsgi:app'],
+        cwd=workdir, env=env, stdout=subprocess.DEVNULL
+    )
+
+    url = f'http://127.0.0.1:{port}'
+    deadline = time.time() + 30
+    while fetch(url + '/api/search?per_page=1', 1) != 200:
+        if process.poll() is not None or time.time() > deadline:
+            process.kill()
+            raise RuntimeError('gunicorn did not start')
+        time.sleep(0.2)
+    return process, url
+
+def run(url, paths, rate, duration, concurrency, timeout):
+    total = int(rate * duration)
+    latencies = []
+    statuses = {}
+    lock = threading.Lock()
+
+    def one(index, scheduled):
+        status = fetch(url + paths[index % len(paths)], timeout)
+        with lock:
+            latencies.append(time.perf_counter() - scheduled)
+            statuses[status] = statuses.get(status, 0) + 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for index in range(total):
+            scheduled = start + index / rate
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            pool.submit(one, index, scheduled)
+    elapsed = time.perf_counter() - start
+
+    errors = sum(count for status, count in statuses.items() if status != 200)
+    print(f"target {rate:.0f} req/s, achieved {len(latencies) / elapsed:.1f} req/s over {elapsed:.1f}s")
+    print(f"latency ms: p50 {percentile(latencies, 50) * 1000:.1f}  p95 {percentile(latencies, 95) * 1000:.1f}  "
+          f"p99 {percentile(latencies, 99) * 1000:.1f}  max {max(latencies) * 1000:.1f}")
+    print(f"statuses: {statuses}, errors: {errors}")
+    return errors
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='http://127.0.0.1:8000', help='Base URL of a running server')
+    parser.add_argument('--serve', type=int, metavar='CONTACTS',
+                        help='Start gunicorn on a fresh database with this many contacts')
+    parser.add_argument('--workers', type=int, help='Gunicorn workers with --serve (default: gunicorn.conf.py)')
+    parser.add_argument('--rate', type=float, default=100, help='Target requests per second')
+    parser.add_argument('--duration', type=float, default=20, help='Seconds of load')
+    parser.add_argument('--concurrency', type=int, default=64, help='Client threads')
+    parser.add_argument('--timeout', type=float, default=10)
+    parser.add_argument('--paths', nargs='+', default=DEFAULT_PATHS, help='Paths requested in turn')
+    args = parser.parse_args()
+
+    process = None
+    url = args.url
+    if args.serve is not None:
+        process, url = start_server(args.serve, args.workers)
+    try:
+        errors = run(url, args.paths, args.rate, args.duration, args.concurrency, args.timeout)
+    finally:
+        if process is not None:
+            # SIGTERM, the graceful shutdown path
+            process.terminate()
+            process.wait(timeout=60)
+    sys.exit(1 if errors else 0)
@@ -0,0 +1,99 @@
+import asyncio
+import threading
+import logging
+
+# Setup logging
+logger = logging.getLogger(__name__)
+
+class SmtpStandIn:
+    """
+    Minimal local SMTP server used as a stand-in for a real provider.
+
+    It accepts every message after an artificial per-message latency, which
+    is what makes concurrency visible in benchmarks. The server runs its own
+    event loop in a background thread.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.05):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.messages = 0
+        self.connections = 0
+        self.recipients = []
+        self._loop = None
+        self._server = None
+        self._thread = None
+        self._ready = threading.Event()
+
+    async def _handle(self, reader, writer):
+        self.connections += 1
+        writer.write(b'220 standin ESMTP ready\r\n')
+        await writer.drain()
+
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                command = line.decode('utf-8', 'replace').strip()
+                verb = command.split(' ', 1)[0].upper()
+
+                if verb == 'EHLO':
+                    writer.write(b'250-standin\r\n250 8BITMIME\r\n')
+                elif verb == 'RCPT':
+                    self.recipients.append(command.split(':', 1)[-1].strip(' <>'))
+                    writer.write(b'250 OK\r\n')
+                elif verb == 'DATA':
+                    writer.write(b'354 End data with <CR><LF>.<CR><LF>\r\n')
+                    await writer.drain()
+                    while (await reader.readline()) not in (b'.\r\n', b''):
+                        pass
+                    await asyncio.sleep(self.latency)
+                    self.messages += 1
+                    writer.write(b'250 OK queued\r\n')
+                elif verb == 'QUIT':
+                    writer.write(b'221 Bye\r\n')
+                    await writer.drain()
+                    break
+                else:
+                    # HELO, MAIL, RSET, NOOP and anything else
+                    writer.write(b'250 OK\r\n')
+                await writer.drain()
+        finally:
+            writer.close()
+
+    def _run(self):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        self._server = self._loop.run_until_complete(
+            asyncio.start_server(self._handle, self.host, self.port)
+        )
+        self.port = self._server.sockets[0].getsockname()[1]
+        self._ready.set()
+        self._loop.run_forever()
+
+        self._server.close()
+        self._loop.run_until_complete(self._server.wait_closed())
+        self._loop.close()
+
+    def start(self):
+        """Start the server and return the port it listens on"""
+        self._thread = threading.Thread(target=self._run, name='smtp-standin', daemon=True)
+        self._thread.start()
+        self._ready.wait()
+        logger.info(f"SMTP stand-in listening on {self.host}:{self.port}")
+        return self.port
+
+    def stop(self):
+        """Stop the server and wait for its thread"""
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
@@ -1,5 +1,7 @@
 import sqlite3
+import json
 import os
+import time
 import logging
 
 # Setup logging
@@ -7,9 +9,36 @@ logger = logging.getLogger(__name__)
 
 DATABASE_FILE = 'email_data.db'
 
+# Seconds a connection waits for another process's write lock before failing,
+# so web workers and the send worker can write to the database at the same time
+DB_BUSY_TIMEOUT = float(os.environ.get('DB_BUSY_TIMEOUT', 30))
+
+# How long a batch may hold a claimed record before start-up recovery reclaims it
+DEFAULT_LEASE_SECONDS = 600
+
+# Text columns indexed for full-text search, also usable as field:term in a query
+SEARCH_FIELDS = ('email', 'company', 'first_name', 'last_name', 'english_job', 'french_job')
+
+# Facets returned by search_contacts, mapped to their column
+SEARCH_FACETS = {
+    'language': 'email_language',
+    'formality': 'formality',
+    'role': 'role',
+    'processed': 'processed',
+}
+
+# Tables that can be exported, mapped to the column they are ordered by
+EXPORT_TABLES = {
+    'contacts': 'id',
+    'send_ledger': 'created_at',
+}
+
+# Whether the contacts_fts table exists, resolved on first use
+_fts_enabled = None
+
 def get_db_connection():
     """Create a database connection and return it"""
-    conn = sqlite3.connect(DATABASE_FILE)
+    conn = sqlite3.connect(DATABASE_FILE, timeout=DB_BUSY_TIMEOUT)
     conn.row_factory = sqlite3.Row
     return conn
 
@@ -35,7 +64,12 @@ def init_db():
             role TEXT NOT NULL DEFAULT 'Trading Assistant',
             cover_letter_language TEXT NOT NULL DEFAULT 'english',
             email_language TEXT NOT NULL DEFAULT 'french',
-            processed BOOLEAN DEFAULT 0
+            processed BOOLEAN DEFAULT 0,
+            state TEXT NOT NULL DEFAULT 'pending',
+            send_attempts INTEGER NOT NULL DEFAULT 0,
+            last_error TEXT,
+            lease_expires_at REAL,
+            send_key TEXT
         )
         ''')
         
@@ -210,11 +244,505 @@ def init_db():
             
             schema_updated = True
         
+        # Re-read the columns, the migrations above may have rebuilt the table
+        cursor.execute("PRAGMA table_info(contacts)")
+        column_names = [column[1] for column in cursor.fetchall()]
+        
+        if 'state' not in column_names:
+            logger.info("Adding state column to contacts table")
+            cursor.execute("ALTER TABLE contacts ADD COLUMN state TEXT NOT NULL DEFAULT 'pending'")
+            cursor.execute("UPDATE contacts SET state = 'sent' WHERE processed = 1")
+            schema_updated = True
+        
+        if 'send_attempts' not in column_names:
+            logger.info("Adding send_attempts column to contacts table")
+            cursor.execute("ALTER TABLE contacts ADD COLUMN send_attempts INTEGER NOT NULL DEFAULT 0")
+            schema_updated = True
+        
+        if 'last_error' not in column_names:
+            logger.info("Adding last_error column to contacts table")
+            cursor.execute("ALTER TABLE contacts ADD COLUMN last_error TEXT")
+            schema_updated = True
+        
+        if 'lease_expires_at' not in column_names:
+            logger.info("Adding lease_expires_at column to contacts table")
+            cursor.execute("ALTER TABLE contacts ADD COLUMN lease_expires_at REAL")
+            schema_updated = True
+        
+        if 'send_key' not in column_names:
+            logger.info("Adding send_key column to contacts table")
+            cursor.execute("ALTER TABLE contacts ADD COLUMN send_key TEXT")
+            schema_updated = True
+        
         if schema_updated:
             conn.commit()
             logger.info("Database schema updated successfully")
         
         conn.close()
+    
+    # Ledger of every message handed to a transport, keyed by idempotency key
+    conn = get_db_connection()
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS send_ledger (
+        idempotency_key TEXT PRIMARY KEY,
+        contact_id INTEGER NOT NULL,
+        email TEXT NOT NULL,
+        status TEXT NOT NULL,
+        last_error TEXT,
+        created_at REAL NOT NULL,
+        updated_at REAL NOT NULL
+    )
+    ''')
+    
+    # Manifest of the files kept under the output directory, see storage.py
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS artifacts (
+        path TEXT PRIMARY KEY,
+        kind TEXT NOT NULL,
+        cache_key TEXT,
+        contact_id INTEGER,
+        size INTEGER NOT NULL,
+        created_at REAL NOT NULL,
+        last_used_at REAL NOT NULL
+    )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_artifacts_cache_key ON artifacts(cache_key, kind)')
+    
+    # Sender account of each recipient company, so follow-ups come from the same sender
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS sender_assignments (
+        company_key TEXT PRIMARY KEY,
+        account TEXT NOT NULL,
+        assigned_at REAL NOT NULL
+    )
+    ''')
+    
+    # Messages reserved per sender account and day, checked against the account's daily quota
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS account_usage (
+        account TEXT NOT NULL,
+        day TEXT NOT NULL,
+        sent INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (account, day)
+    )
+    ''')
+    
+    # Batches queued by the web server and run by the send worker, see send_worker.py
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS send_jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        kind TEXT NOT NULL,
+        payload TEXT NOT NULL DEFAULT '{}',
+        status TEXT NOT NULL DEFAULT 'queued',
+        worker TEXT,
+        summary TEXT,
+        created_at REAL NOT NULL,
+        started_at REAL,
+        finished_at REAL
+    )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_send_jobs_status ON send_jobs(status, id)')
+    
+    # Counter bumped by every change to the contacts, used to invalidate cached pages
+    conn.execute('CREATE TABLE IF NOT EXISTS data_version (id INTEGER PRIMARY KEY CHECK (id = 1), version INTEGER NOT NULL)')
+    conn.execute('INSERT OR IGNORE INTO data_version (id, version) VALUES (1, 0)')
+    for event in ('INSERT', 'UPDATE', 'DELETE'):
+        conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS contacts_version_{event.lower()} AFTER {event} ON contacts BEGIN
+            UPDATE data_version SET version = version + 1 WHERE id = 1;
+        END
+        ''')
+    conn.commit()
+    
+    # WAL lets long reads (streamed batches, exports) run alongside the send loop's writes
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.close()
+    
+    init_search_index()
+
+def init_search_index():
+    """
+    Create the FTS5 index over the contact text fields and the triggers keeping it in sync.
+    
+    Falls back to LIKE searches when the SQLite build has no FTS5 support.
+    """
+    global _fts_enabled
+    
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    _init_facet_counts(cursor)
+    _init_facet_keys(cursor)
+    
+    columns = ', '.join(SEARCH_FIELDS)
+    new_values = ', '.join(f'new.{field}' for field in SEARCH_FIELDS)
+    old_values = ', '.join(f'old.{field}' for field in SEARCH_FIELDS)
+    
+    try:
+        cursor.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS contacts_fts USING fts5({columns}, content='contacts', content_rowid='id', prefix='2 3')")
+    except sqlite3.OperationalError as e:
+        logger.warning(f"Full-text search unavailable, falling back to LIKE queries: {str(e)}")
+        conn.commit()
+        conn.close()
+        _fts_enabled = False
+        return False
+    
+    # Table rebuilds in the migrations drop the triggers, in which case the index is stale
+    cursor.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'trigger' AND name LIKE 'contacts_fts_%'")
+    rebuild = cursor.fetchone()[0] < 3
+    
+    cursor.execute(f'''
+    CREATE TRIGGER IF NOT EXISTS contacts_fts_insert AFTER INSERT ON contacts BEGIN
+        INSERT INTO contacts_fts (rowid, {columns}) VALUES (new.id, {new_values});
+    END
+    ''')
+    cursor.execute(f'''
+    CREATE TRIGGER IF NOT EXISTS contacts_fts_delete AFTER DELETE ON contacts BEGIN
+        INSERT INTO contacts_fts (contacts_fts, rowid, {columns}) VALUES ('delete', old.id, {old_values});
+    END
+    ''')
+    # Only text changes touch the index, state updates from the send loop do not
+    cursor.execute(f'''
+    CREATE TRIGGER IF NOT EXISTS contacts_fts_update AFTER UPDATE OF {columns} ON contacts BEGIN
+        INSERT INTO contacts_fts (contacts_fts, rowid, {columns}) VALUES ('delete', old.id, {old_values});
+        INSERT INTO contacts_fts (rowid, {columns}) VALUES (new.id, {new_values});
+    END
+    ''')
+    
+    if rebuild:
+        logger.info("Rebuilding full-text search index")
+        cursor.execute("INSERT INTO contacts_fts (contacts_fts) VALUES ('rebuild')")
+    
+    conn.commit()
+    conn.close()
+    _fts_enabled = True
+    return True
+
+def _init_facet_counts(cursor):
+    """
+    Keep per-combination facet counts up to date with triggers.
+    
+    Searches without text then read the counts from this small table
+    instead of scanning the contacts.
+    """
+    columns = ', '.join(SEARCH_FACETS.values())
+    
+    # Table rebuilds in the migrations drop the triggers, in which case the counts are stale
+    cursor.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'trigger' AND name LIKE 'contact_facets_%'")
+    rebuild = cursor.fetchone()[0] < 3
+    
+    cursor.execute(f'CREATE TABLE IF NOT EXISTS contact_facet_counts ({columns}, count INTEGER NOT NULL)')
+    
+    def adjust(row, delta):
+        match = ' AND '.join(f'{column} IS {row}.{column}' for column in SEARCH_FACETS.values())
+        values = ', '.join(f'{row}.{column}' for column in SEARCH_FACETS.values())
+        return f'''
+        INSERT INTO contact_facet_counts ({columns}, count)
+        SELECT {values}, 0 WHERE NOT EXISTS (SELECT 1 FROM contact_facet_counts WHERE {match});
+        UPDATE contact_facet_counts SET count = count {delta} WHERE {match};
+        '''
+    
+    cursor.execute(f"CREATE TRIGGER IF NOT EXISTS contact_facets_insert AFTER INSERT ON contacts BEGIN {adjust('new', '+ 1')} END")
+    cursor.execute(f"CREATE TRIGGER IF NOT EXISTS contact_facets_delete AFTER DELETE ON contacts BEGIN {adjust('old', '- 1')} END")
+    cursor.execute(f"CREATE TRIGGER IF NOT EXISTS contact_facets_update AFTER UPDATE OF {columns} ON contacts "
+                   f"BEGIN {adjust('old', '- 1')} {adjust('new', '+ 1')} END")
+    
+    if rebuild:
+        cursor.execute('DELETE FROM contact_facet_counts')
+        cursor.execute(f'INSERT INTO contact_facet_counts SELECT {columns}, COUNT(*) FROM contacts GROUP BY {columns}')
+
+def _init_facet_keys(cursor):
+    """
+    Map every contact to the ID of its facet combination, kept up to date with triggers.
+    
+    Counting the facets of a text search then reads one small row per match
+    instead of the whole contact, which keeps broad searches fast.
+    """
+    columns = ', '.join(SEARCH_FACETS.values())
+    
+    # Table rebuilds in the migrations drop the triggers, in which case the keys are stale
+    cursor.execute("SELECT COUNT(*) FROM sqlite_master WHERE name = 'contact_facet_keys' "
+                   "OR (type = 'trigger' AND name LIKE 'contact_facet_keys_%')")
+    rebuild = cursor.fetchone()[0] < 4
+    
+    cursor.execute(f'CREATE TABLE IF NOT EXISTS contact_facet_combos (id INTEGER PRIMARY KEY, {columns})')
+    cursor.execute('CREATE TABLE IF NOT EXISTS contact_facet_keys (id INTEGER PRIMARY KEY, combo INTEGER NOT NULL)')
+    
+    def same_combo(row):
+        return ' AND '.join(f'contact_facet_combos.{column} IS {row}.{column}' for column in SEARCH_FACETS.values())
+    
+    values = ', '.join(f'new.{column}' for column in SEARCH_FACETS.values())
+    assign = f'''
+    INSERT INTO contact_facet_combos ({columns})
+    SELECT {values} WHERE NOT EXISTS (SELECT 1 FROM contact_facet_combos WHERE {same_combo('new')});
+    INSERT OR REPLACE INTO contact_facet_keys (id, combo)
+    SELECT new.id, id FROM contact_facet_combos WHERE {same_combo('new')} LIMIT 1;
+    '''
+    cursor.execute(f"CREATE TRIGGER IF NOT EXISTS contact_facet_keys_insert AFTER INSERT ON contacts BEGIN {assign} END")
+    cursor.execute(f"CREATE TRIGGER IF NOT EXISTS contact_facet_keys_update AFTER UPDATE OF {columns} ON contacts BEGIN {assign} END")
+    cursor.execute("CREATE TRIGGER IF NOT EXISTS contact_facet_keys_delete AFTER DELETE ON contacts "
+                   "BEGIN DELETE FROM contact_facet_keys WHERE id = old.id; END")
+    
+    if rebuild:
+        cursor.execute('DELETE FROM contact_facet_keys')
+        cursor.execute(f'''
+        INSERT INTO contact_facet_combos ({columns})
+        SELECT DISTINCT {columns} FROM contacts WHERE NOT EXISTS (SELECT 1 FROM contact_facet_combos WHERE {same_combo('contacts')})
+        ''')
+        cursor.execute(f'''
+        INSERT INTO contact_facet_keys (id, combo)
+        SELECT id, (SELECT contact_facet_combos.id FROM contact_facet_combos WHERE {same_combo('contacts')} LIMIT 1) FROM contacts
+        ''')
+
+def _search_enabled(conn):
+    global _fts_enabled
+    
+    if _fts_enabled is None:
+        row = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'contacts_fts'").fetchone()
+        _fts_enabled = row is not None
+    return _fts_enabled
+
+def build_match_query(query):
+    """
+    Turn a user query into an FTS5 MATCH expression.
+    
+    Every word is a prefix match and all words must match. A word can be
+    restricted to one field with field:word (for example company:bnp).
+    """
+    terms = []
+    for token in (query or '').split():
+        field = None
+        name, separator, rest = token.partition(':')
+        if separator and name in SEARCH_FIELDS and rest:
+            field, token = name, rest
+        
+        token = token.replace('"', '')
+        if not token:
+            continue
+        
+        term = f'"{token}"*'
+        terms.append(f'{field} : {term}' if field else term)
+    
+    return ' AND '.join(terms)
+
+def _active_facets(filters):
+    """Return the facet filters that are set, by name, with their values as stored"""
+    active = {}
+    for name, value in (filters or {}).items():
+        if name not in SEARCH_FACETS or value is None or value == '':
+            continue
+        if name == 'processed':
+            value = 1 if str(value).lower() in ('1', 'true', 'yes') else 0
+        active[name] = value
+    return active
+
+def _facet_filter(filters):
+    """Return the (clauses, params) restricting the facet columns"""
+    active = _active_facets(filters)
+    return [f'{SEARCH_FACETS[name]} = ?' for name in active], list(active.values())
+
+def _text_filter(conn, query):
+    """Return the (clauses, params) matching the query words against the text fields"""
+    if _search_enabled(conn):
+        match = build_match_query(query)
+        if match:
+            return ['id IN (SELECT rowid FROM contacts_fts WHERE contacts_fts MATCH ?)'], [match]
+        return [], []
+    
+    clauses = []
+    params = []
+    for token in (query or '').split():
+        name, separator, rest = token.partition(':')
+        if separator and name in SEARCH_FIELDS and rest:
+            fields, token = [name], rest
+        else:
+            fields = SEARCH_FIELDS
+        clauses.append('(' + ' OR '.join(f'{field} LIKE ?' for field in fields) + ')')
+        params.extend([f'%{token}%'] * len(fields))
+    return clauses, params
+
+def _where(clauses):
+    return ' WHERE ' + ' AND '.join(clauses) if clauses else ''
+
+def build_search_filter(conn, query='', filters=None):
+    """
+    Build the WHERE clause selecting the contacts matching a query and facet filters.
+    
+    Returns:
+    - Tuple of (sql, params), sql being empty when nothing is filtered
+    """
+    text_clauses, text_params = _text_filter(conn, query)
+    facet_clauses, facet_params = _facet_filter(filters)
+    return _where(text_clauses + facet_clauses), text_params + facet_params
+
+def search_contacts(query='', filters=None, page=1, per_page=50):
+    """
+    Search contacts with prefix matching, facet filters and pagination.
+    
+    Facet counts are exact, and each facet is counted with the other facet
+    filters applied but not its own, so picking a value keeps the others of
+    that facet listed. The counts of a text search read one small row per
+    match from contact_facet_keys instead of the contact itself.
+    
+    Parameters:
+    - query: Words to match against the text fields (see build_match_query)
+    - filters: Dictionary of facet name to value (see SEARCH_FACETS)
+    - page: 1-based page number
+    - per_page: Records per page
+    
+    Returns:
+    - Dictionary with records, total, facets (value counts per facet), page, per_page and pages
+    """
+    page = max(1, int(page))
+    per_page = max(1, int(per_page))
+    offset = (page - 1) * per_page
+    columns = ', '.join(SEARCH_FACETS.values())
+    
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    facet_clauses, facet_params = _facet_filter(filters)
+    match = build_match_query(query) if _search_enabled(conn) else ''
+    
+    # Counts per facet combination of every text match, the facet filters are applied below
+    if match:
+        # Drive both queries from the index; rows come back in rowid order so the page stops early
+        cursor.execute(f'''
+        SELECT {columns}, matches.count FROM (
+            SELECT combo, COUNT(*) AS count FROM contacts_fts JOIN contact_facet_keys ON contact_facet_keys.id = contacts_fts.rowid
+            WHERE contacts_fts MATCH ? GROUP BY combo
+        ) matches JOIN contact_facet_combos ON contact_facet_combos.id = matches.combo
+        ''', [match])
+        combos = cursor.fetchall()
+        source = 'contacts_fts JOIN contacts ON contacts.id = contacts_fts.rowid'
+        cursor.execute(f'SELECT contacts.* FROM {source}{_where(["contacts_fts MATCH ?"] + facet_clauses)} '
+                       f'ORDER BY contacts_fts.rowid LIMIT ? OFFSET ?', [match] + facet_params + [per_page, offset])
+    elif not (query or '').strip():
+        # Without text the counts come from the trigger-maintained table
+        cursor.execute(f'SELECT {columns}, SUM(count) AS count FROM contact_facet_counts WHERE count > 0 GROUP BY {columns}')
+        combos = cursor.fetchall()
+        cursor.execute(f'SELECT * FROM contacts{_where(facet_clauses)} ORDER BY id LIMIT ? OFFSET ?',
+                       facet_params + [per_page, offset])
+    else:
+        text_where, text_params = build_search_filter(conn, query)
+        cursor.execute(f'SELECT {columns}, COUNT(*) AS count FROM contacts{text_where} GROUP BY {columns}', text_params)
+        combos = cursor.fetchall()
+        where, params = build_search_filter(conn, query, filters)
+        cursor.execute(f'SELECT * FROM contacts{where} ORDER BY id LIMIT ? OFFSET ?', params + [per_page, offset])
+    
+    records = cursor.fetchall()
+    conn.close()
+    
+    active = _active_facets(filters)
+    total = 0
+    facets = {name: {} for name in SEARCH_FACETS}
+    for row in combos:
+        # Facets this combination fails, a combination counts towards a facet when it passes all the others
+        failed = [name for name, value in active.items() if row[SEARCH_FACETS[name]] != value]
+        if not failed:
+            total += row['count']
+        for name, column in SEARCH_FACETS.items():
+            if not failed or failed == [name]:
+                facets[name][row[column]] = facets[name].get(row[column], 0) + row['count']
+    
+    return {
+        'records': records,
+        'total': total,
+        'facets': facets,
+        'page': page,
+        'per_page': per_page,
+        'pages': max(1, -(-total // per_page)),
+    }
+
+def count_sendable_contacts(query='', filters=None):
+    """Count the pending contacts matching a search, without loading them"""
+    conn = get_db_connection()
+    where, params = build_search_filter(conn, query, filters)
+    where += (' AND ' if where else ' WHERE ') + "processed = 0 AND state = 'pending'"
+    
+    count = conn.execute(f'SELECT COUNT(*) FROM contacts{where}', params).fetchone()[0]
+    conn.close()
+    return count
+
+def iter_sendable_contacts(query='', filters=None, chunk_size=100):
+    """
+    Yield the pending contacts matching a search, streamed from a single query.
+    
+    Rows are fetched chunk_size at a time, so a large selection is never held
+    in memory at once.
+    """
+    conn = get_db_connection()
+    try:
+        where, params = build_search_filter(conn, query, filters)
+        where += (' AND ' if where else ' WHERE ') + "processed = 0 AND state = 'pending'"
+        
+        cursor = conn.execute(f'SELECT * FROM contacts{where} ORDER BY id', params)
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield from rows
+    finally:
+        conn.close()
+
+def iter_export_rows(table, query='', filters=None, chunk_size=500):
+    """
+    Yield the column names of a table, then its rows, from a read snapshot.
+    
+    The rows come from a single read transaction, so the export is consistent
+    even while sends write to the database, and in WAL mode it does not block
+    them. Rows are fetched chunk_size at a time, keeping memory flat.
+    
+    Parameters:
+    - table: Name of a table in EXPORT_TABLES
+    - query, filters: Search restricting exported contacts (see search_contacts)
+    - chunk_size: Rows fetched per round trip
+    """
+    if table not in EXPORT_TABLES:
+        raise ValueError(f"Unknown export table: {table}")
+    
+    conn = get_db_connection()
+    try:
+        conn.execute('BEGIN')
+        where, params = build_search_filter(conn, query, filters) if table == 'contacts' else ('', [])
+        
+        cursor = conn.execute(f'SELECT * FROM {table}{where} ORDER BY {EXPORT_TABLES[table]}', params)
+        yield [column[0] for column in cursor.description]
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield from rows
+    finally:
+        conn.close()
+
+def get_data_version():
+    """
+    Return the contacts data version.
+    
+    Every insert, update or delete on the contacts (add_record, update_record,
+    delete_record, mark_as_processed, but also the send path) increments it,
+    from any process, so it tells whether cached pages are still current.
+    """
+    conn = get_db_connection()
+    row = conn.execute('SELECT version FROM data_version WHERE id = 1').fetchone()
+    conn.close()
+    return row['version'] if row else 0
+
+def get_records_by_ids(ids):
+    """Get the records with the given IDs, in ID order, in as few queries as possible"""
+    ids = sorted(set(ids))
+    records = []
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    # Stay under SQLite's bound parameter limit
+    for start in range(0, len(ids), 500):
+        chunk = ids[start:start + 500]
+        cursor.execute(f"SELECT * FROM contacts WHERE id IN ({', '.join('?' * len(chunk))}) ORDER BY id", chunk)
+        records.extend(cursor.fetchall())
+    
+    conn.close()
+    return records
 
 def get_all_records(id=None):
     """Get all records or a specific record by ID"""
@@ -250,13 +778,31 @@ def add_record(email, english_job, french_job, company, first_name, last_name, t
     return record_id
 
 def update_record(id, email, english_job, french_job, company, first_name, last_name, title, formality, role, cover_letter_language, email_language):
-    """Update an existing record"""
+    """
+    Update an existing record and put it back in the queue.
+    
+    Saving a record is the user's go-ahead to send it again: messages already
+    sent to it are marked 'superseded' in the ledger, so the next batch sends
+    a new one instead of skipping it as already sent.
+    """
     conn = get_db_connection()
     cursor = conn.cursor()
+    now = time.time()
+    
+    cursor.execute("UPDATE send_ledger SET status = 'superseded', updated_at = ? WHERE contact_id = ? AND status = 'sent'",
+                   (now, id))
+    
+    # Saving the record is the user's go-ahead to send a message whose outcome was
+    # unknown again (rows left 'sending' on a dead-lettered record predate 'unknown')
+    cursor.execute('''
+    UPDATE send_ledger SET status = 'failed', last_error = 'Outcome unknown, sent again after the record was edited', updated_at = ?
+    WHERE contact_id = ? AND (status = 'unknown' OR (status = 'sending' AND (SELECT state FROM contacts WHERE id = ?) = 'dead'))
+    ''', (now, id, id))
     
     cursor.execute('''
     UPDATE contacts 
-    SET email = ?, english_job = ?, french_job = ?, company = ?, first_name = ?, last_name = ?, title = ?, formality = ?, role = ?, cover_letter_language = ?, email_language = ?, processed = 0
+    SET email = ?, english_job = ?, french_job = ?, company = ?, first_name = ?, last_name = ?, title = ?, formality = ?, role = ?, cover_letter_language = ?, email_language = ?, processed = 0,
+        state = 'pending', send_attempts = 0, last_error = NULL, lease_expires_at = NULL, send_key = NULL
     WHERE id = ?
     ''', (email, english_job, french_job, company, first_name, last_name, title, formality, role, cover_letter_language, email_language, id))
     
@@ -284,10 +830,452 @@ def mark_as_processed(id):
     conn = get_db_connection()
     cursor = conn.cursor()
     
-    cursor.execute('UPDATE contacts SET processed = 1 WHERE id = ?', (id,))
+    cursor.execute("UPDATE contacts SET processed = 1, state = 'sent', last_error = NULL, lease_expires_at = NULL WHERE id = ?", (id,))
     
     conn.commit()
     conn.close()
     
     logger.info(f"Marked record ID: {id} as processed")
-    return True 
\ No newline at end of file
+    return True 
+
+def record_preflight_errors(errors):
+    """
+    Store why records failed the pre-flight check, without counting a send attempt.
+    
+    Parameters:
+    - errors: List of (record ID, message) tuples
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    cursor.executemany("UPDATE contacts SET last_error = ? WHERE id = ? AND state = 'pending'",
+                       [(message, id) for id, message in errors])
+    
+    conn.commit()
+    conn.close()
+    return True
+
+def record_send_failure(id, error):
+    """Store a failed send attempt and return the number of attempts so far"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    cursor.execute('UPDATE contacts SET send_attempts = send_attempts + 1, last_error = ? WHERE id = ?', (error, id))
+    cursor.execute('SELECT send_attempts FROM contacts WHERE id = ?', (id,))
+    row = cursor.fetchone()
+    
+    conn.commit()
+    conn.close()
+    
+    attempts = row['send_attempts'] if row else 0
+    logger.info(f"Recorded failed attempt {attempts} for record ID: {id}")
+    return attempts
+
+def mark_as_dead_letter(id, error):
+    """Move a record to the dead-letter state after too many failed attempts"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    cursor.execute("UPDATE contacts SET state = 'dead', last_error = ?, lease_expires_at = NULL WHERE id = ?", (error, id))
+    
+    conn.commit()
+    conn.close()
+    
+    logger.warning(f"Moved record ID: {id} to dead letter: {error}")
+    return True
+
+def claim_record(id, lease_seconds=DEFAULT_LEASE_SECONDS):
+    """
+    Atomically claim a pending record for sending.
+    
+    Returns True if this caller now owns the record, False if it was already
+    claimed, sent or dead-lettered.
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    cursor.execute(
+        "UPDATE contacts SET state = 'sending', lease_expires_at = ? WHERE id = ? AND state = 'pending'",
+        (time.time() + lease_seconds, id)
+    )
+    claimed = cursor.rowcount == 1
+    
+    conn.commit()
+    conn.close()
+    
+    return claimed
+
+def release_claim(id):
+    """Return a claimed record to the pending state"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    cursor.execute("UPDATE contacts SET state = 'pending', lease_expires_at = NULL WHERE id = ? AND state = 'sending'", (id,))
+    
+    conn.commit()
+    conn.close()
+    
+    logger.info(f"Released claim on record ID: {id}")
+    return True
+
+def begin_send(idempotency_key, contact_id, email):
+    """
+    Record in the send ledger that a message is about to be handed to a transport.
+    
+    Returns False if the same message was already sent or is being sent,
+    in which case it must not be sent again. Failed messages can be retried,
+    and so can messages superseded by an edit of their record.
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    now = time.time()
+    
+    cursor.execute('''
+    INSERT INTO send_ledger (idempotency_key, contact_id, email, status, created_at, updated_at)
+    VALUES (?, ?, ?, 'sending', ?, ?)
+    ON CONFLICT(idempotency_key) DO UPDATE SET status = 'sending', updated_at = excluded.updated_at
+    WHERE send_ledger.status IN ('failed', 'superseded')
+    ''', (idempotency_key, contact_id, email, now, now))
+    allowed = cursor.rowcount == 1
+    
+    if allowed:
+        # Remember which message is in flight so start-up recovery can find its outcome
+        cursor.execute('UPDATE contacts SET send_key = ? WHERE id = ?', (idempotency_key, contact_id))
+    
+    conn.commit()
+    conn.close()
+    
+    return allowed
+
+def get_ledger_status(idempotency_key):
+    """Return the ledger status of a message, or None if it was never sent"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    cursor.execute('SELECT status FROM send_ledger WHERE idempotency_key = ?', (idempotency_key,))
+    row = cursor.fetchone()
+    conn.close()
+    
+    return row['status'] if row else None
+
+def complete_send(idempotency_key, contact_id):
+    """Mark a message as sent in the ledger and its record as processed, in one transaction"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    cursor.execute("UPDATE send_ledger SET status = 'sent', last_error = NULL, updated_at = ? WHERE idempotency_key = ?",
+                   (time.time(), idempotency_key))
+    cursor.execute("UPDATE contacts SET processed = 1, state = 'sent', last_error = NULL, lease_expires_at = NULL WHERE id = ?",
+                   (contact_id,))
+    
+    conn.commit()
+    conn.close()
+    
+    logger.info(f"Marked record ID: {contact_id} as processed")
+    return True
+
+def fail_send(idempotency_key, error):
+    """Mark a message as failed in the ledger so it can be retried"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    cursor.execute("UPDATE send_ledger SET status = 'failed', last_error = ?, updated_at = ? WHERE idempotency_key = ?",
+                   (error, time.time(), idempotency_key))
+    
+    conn.commit()
+    conn.close()
+    return True
+
+def recover_stuck_claims():
+    """
+    Resolve records whose claim expired, typically after a crash.
+    
+    - Message recorded as sent in the ledger: the record is marked processed.
+    - Message handed to a transport without an outcome: the record is moved
+      to dead letter, since it may or may not have gone out, and its ledger
+      row is marked 'unknown'. Editing the record marks it failed, which
+      allows the message to be sent again.
+    - Otherwise (crash before sending): the record goes back to pending.
+    
+    Returns:
+    - Number of records recovered
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    now = time.time()
+    expired = "state = 'sending' AND (lease_expires_at IS NULL OR lease_expires_at < ?)"
+    ledger_status = "(SELECT status FROM send_ledger WHERE idempotency_key = contacts.send_key)"
+    
+    cursor.execute(f'''
+    UPDATE contacts SET processed = 1, state = 'sent', last_error = NULL, lease_expires_at = NULL
+    WHERE {expired} AND {ledger_status} = 'sent'
+    ''', (now,))
+    sent = cursor.rowcount
+    
+    cursor.execute(f'''
+    UPDATE send_ledger SET status = 'unknown', updated_at = ?
+    WHERE status = 'sending' AND idempotency_key IN (SELECT send_key FROM contacts WHERE {expired})
+    ''', (now, now))
+    cursor.execute(f'''
+    UPDATE contacts SET state = 'dead', lease_expires_at = NULL,
+        last_error = 'Interrupted while sending, check the sent items and edit the record to retry'
+    WHERE {expired} AND {ledger_status} = 'unknown'
+    ''', (now,))
+    interrupted = cursor.rowcount
+    
+    cursor.execute(f"UPDATE contacts SET state = 'pending', lease_expires_at = NULL WHERE {expired}", (now,))
+    released = cursor.rowcount
+    
+    conn.commit()
+    conn.close()
+    
+    if sent or interrupted or released:
+        logger.warning(f"Recovered stuck claims: {sent} sent, {interrupted} interrupted, {released} released")
+    return sent + interrupted + released
+
+def record_artifact(path, kind, size, cache_key=None, contact_id=None):
+    """Add a file to the artifact manifest, or refresh its entry"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    now = time.time()
+    
+    cursor.execute('''
+    INSERT INTO artifacts (path, kind, cache_key, contact_id, size, created_at, last_used_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(path) DO UPDATE SET kind = excluded.kind, cache_key = excluded.cache_key,
+        contact_id = excluded.contact_id, size = excluded.size, last_used_at = excluded.last_used_at
+    ''', (path, kind, cache_key, contact_id, size, now, now))
+    
+    conn.commit()
+    conn.close()
+    return True
+
+def find_artifact(cache_key, kind):
+    """Return the path of the artifact cached under a key and mark it as used, or None"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    cursor.execute('SELECT path FROM artifacts WHERE cache_key = ? AND kind = ?', (cache_key, kind))
+    row = cursor.fetchone()
+    if row:
+        cursor.execute('UPDATE artifacts SET last_used_at = ? WHERE path = ?', (time.time(), row['path']))
+        conn.commit()
+    conn.close()
+    
+    return row['path'] if row else None
+
+def get_artifacts():
+    """
+    Return every manifest entry, least recently used first.
+    
+    Each row also carries the state of its contact, if any, so files of a
+    record that is being sent can be left alone.
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    cursor.execute('''
+    SELECT artifacts.*, contacts.state AS contact_state FROM artifacts
+    LEFT JOIN contacts ON contacts.id = artifacts.contact_id
+    ORDER BY artifacts.last_used_at
+    ''')
+    artifacts = cursor.fetchall()
+    conn.close()
+    
+    return artifacts
+
+def delete_artifacts(paths):
+    """Remove manifest entries"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    cursor.executemany('DELETE FROM artifacts WHERE path = ?', [(path,) for path in paths])
+    
+    conn.commit()
+    conn.close()
+    return True
+
+def assign_sender(company_key, account, replace=False):
+    """
+    Assign a sender account to a company unless it already has one.
+    
+    Parameters:
+    - company_key: Company the assignment is for
+    - account: Name of the sender account
+    - replace: Overwrite an existing assignment
+    
+    Returns:
+    - The account assigned to the company, which is the existing one if
+      another batch assigned it first
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    conflict = 'DO UPDATE SET account = excluded.account, assigned_at = excluded.assigned_at' if replace else 'DO NOTHING'
+    cursor.execute(f'''
+    INSERT INTO sender_assignments (company_key, account, assigned_at) VALUES (?, ?, ?)
+    ON CONFLICT(company_key) {conflict}
+    ''', (company_key, account, time.time()))
+    cursor.execute('SELECT account FROM sender_assignments WHERE company_key = ?', (company_key,))
+    assigned = cursor.fetchone()['account']
+    
+    conn.commit()
+    conn.close()
+    return assigned
+
+def get_sender_assignment(company_key):
+    """Return the sender account assigned to a company, or None"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    cursor.execute('SELECT account FROM sender_assignments WHERE company_key = ?', (company_key,))
+    row = cursor.fetchone()
+    conn.close()
+    
+    return row['account'] if row else None
+
+def reserve_account_quota(account, day, quota=None):
+    """
+    Count one message against an account's usage for the day.
+    
+    Returns False, without counting it, if the account already reached its quota.
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    cursor.execute('INSERT OR IGNORE INTO account_usage (account, day, sent) VALUES (?, ?, 0)', (account, day))
+    if quota is None:
+        cursor.execute('UPDATE account_usage SET sent = sent + 1 WHERE account = ? AND day = ?', (account, day))
+    else:
+        cursor.execute('UPDATE account_usage SET sent = sent + 1 WHERE account = ? AND day = ? AND sent < ?',
+                       (account, day, quota))
+    reserved = cursor.rowcount == 1
+    
+    conn.commit()
+    conn.close()
+    return reserved
+
+def release_account_quota(account, day):
+    """Give back a message reserved with reserve_account_quota that was not sent"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    cursor.execute('UPDATE account_usage SET sent = sent - 1 WHERE account = ? AND day = ? AND sent > 0', (account, day))
+    
+    conn.commit()
+    conn.close()
+    return True
+
+def get_account_usage(day):
+    """Return the number of messages counted per account for a day"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    cursor.execute('SELECT account, sent FROM account_usage WHERE day = ?', (day,))
+    usage = {row['account']: row['sent'] for row in cursor.fetchall()}
+    conn.close()
+    
+    return usage
+
+def enqueue_send_job(kind, payload=None):
+    """
+    Queue a batch for the send worker.
+    
+    Parameters:
+    - kind: 'all', 'selected' or 'filter', see send_worker.job_records
+    - payload: JSON-serialisable dictionary describing the records to send
+    
+    Returns:
+    - ID of the queued job
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    cursor.execute('INSERT INTO send_jobs (kind, payload, created_at) VALUES (?, ?, ?)',
+                   (kind, json.dumps(payload or {}), time.time()))
+    job_id = cursor.lastrowid
+    
+    conn.commit()
+    conn.close()
+    
+    logger.info(f"Queued send job {job_id} ({kind})")
+    return job_id
+
+def claim_send_job(worker):
+    """
+    Atomically take the oldest queued job for a send worker.
+    
+    Returns:
+    - The job row with its payload decoded, or None when the queue is empty
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    # Take the write lock first so two workers cannot read the same queued job
+    cursor.execute('BEGIN IMMEDIATE')
+    cursor.execute("SELECT * FROM send_jobs WHERE status = 'queued' ORDER BY id LIMIT 1")
+    job = cursor.fetchone()
+    if job:
+        cursor.execute("UPDATE send_jobs SET status = 'running', worker = ?, started_at = ? WHERE id = ?",
+                       (worker, time.time(), job['id']))
+    
+    conn.commit()
+    conn.close()
+    
+    if job is None:
+        return None
+    job = dict(job)
+    job['payload'] = json.loads(job['payload'])
+    return job
+
+def finish_send_job(id, status, summary):
+    """Store the outcome of a job: 'done', 'failed', or 'queued' to run it again later"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    cursor.execute('UPDATE send_jobs SET status = ?, summary = ?, finished_at = ? WHERE id = ?',
+                   (status, summary, time.time(), id))
+    
+    conn.commit()
+    conn.close()
+    return True
+
+def recover_send_jobs(worker=None):
+    """
+    Put jobs left running by a stopped send worker back in the queue.
+    
+    Parameters:
+    - worker: Only recover the jobs of this worker (None for every worker)
+    
+    Returns:
+    - Number of jobs queued again
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    if worker is None:
+        cursor.execute("UPDATE send_jobs SET status = 'queued', worker = NULL WHERE status = 'running'")
+    else:
+        cursor.execute("UPDATE send_jobs SET status = 'queued', worker = NULL WHERE status = 'running' AND worker = ?",
+                       (worker,))
+    recovered = cursor.rowcount
+    
+    conn.commit()
+    conn.close()
+    
+    if recovered:
+        logger.warning(f"Queued {recovered} interrupted send jobs again")
+    return recovered
+
+def get_send_jobs(limit=20):
+    """Return the most recent send jobs, newest first"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    cursor.execute('SELECT * FROM send_jobs ORDER BY id DESC LIMIT ?', (limit,))
+    jobs = [dict(row) for row in cursor.fetchall()]
+    conn.close()
+    
+    for job in jobs:
+        job['payload'] = json.loads(job['payload'])
+    return jobs
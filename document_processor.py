@@ -1,43 +1,157 @@
 import os
+import json
+import shutil
+import hashlib
+import tempfile
 import logging
 from datetime import datetime
 from docxtpl import DocxTemplate
-from docx2pdf import convert
 import locale
-import pythoncom
+import pdf_optimizer
+import storage
+
+try:
+    from docx2pdf import convert
+except ImportError:
+    convert = None
+
+try:
+    import pythoncom
+except ImportError:  # COM is only available on Windows
+    pythoncom = None
 
 # Setup logging
 logger = logging.getLogger(__name__)
 
+# File names of the generated attachments
+CV_FILENAME = 'CV - Justin Isambert.pdf'
+COVER_LETTER_FILENAME = 'Cover Letter - Justin Isambert.pdf'
+
+# Parsed email templates, keyed by path and invalidated when the file changes
+_email_templates = {}
+
+def word_converter(docx_path, pdf_path):
+    """
+    Convert a docx file to PDF with Word through docx2pdf.
+    """
+    if convert is None:
+        raise RuntimeError("Word conversion requires docx2pdf, use set_converter to pick another converter")
+    
+    if pythoncom is None:
+        convert(docx_path, pdf_path)
+        return
+    
+    # Initialize COM before calling Word automation
+    pythoncom.CoInitialize()
+    try:
+        convert(docx_path, pdf_path)
+    finally:
+        # Uninitialize COM
+        pythoncom.CoUninitialize()
+
+# Function turning a docx file into a PDF, replaceable with set_converter
+_converter = word_converter
+
+def set_converter(converter):
+    """
+    Replace the docx to PDF converter.
+    
+    Parameters:
+    - converter: Callable taking (docx_path, pdf_path)
+    
+    Returns:
+    - The previous converter
+    """
+    global _converter
+    previous = _converter
+    _converter = converter
+    return previous
+
+def document_key(template_path, context):
+    """Hash of everything that determines a generated PDF"""
+    digest = hashlib.sha256()
+    with open(template_path, 'rb') as file:
+        digest.update(file.read())
+    digest.update(json.dumps(context, sort_keys=True, default=str).encode('utf-8'))
+    digest.update(getattr(_converter, '__name__', repr(_converter)).encode('utf-8'))
+    digest.update(pdf_optimizer.settings_signature().encode('utf-8'))
+    return digest.hexdigest()
+
+def render_pdf(template_path, context, docx_path, pdf_path):
+    """
+    Render a docx template with the context and convert it to PDF.
+    
+    With PDF_OPTIMIZE enabled the PDF is also compressed, and the result is
+    cached per input hash so identical documents skip rendering, conversion
+    and optimization entirely.
+    
+    Parameters:
+    - template_path: Path of the docx template
+    - context: Dictionary of template variables
+    - docx_path: Temporary docx file to render into
+    - pdf_path: PDF file to produce
+    """
+    key = None
+    if pdf_optimizer.PDF_OPTIMIZE:
+        key = document_key(template_path, context)
+        cached_pdf = storage.lookup(key, 'pdf_cache')
+        if cached_pdf:
+            shutil.copyfile(cached_pdf, pdf_path)
+            size = os.path.getsize(pdf_path)
+            pdf_optimizer.record_stats(size, size, cache_hit=True)
+            logger.debug(f"Reused cached PDF for {os.path.basename(pdf_path)}")
+            return
+    
+    # Create template object and render it with the context
+    doc = DocxTemplate(template_path)
+    doc.render(context)
+    doc.save(docx_path)
+    
+    # Convert to PDF
+    _converter(docx_path, pdf_path)
+    
+    # Remove temporary docx file
+    os.remove(docx_path)
+    
+    if key:
+        before, after = pdf_optimizer.optimize_pdf(pdf_path)
+        pdf_optimizer.record_stats(before, after)
+        
+        # Write under a temporary name so concurrent renders never read a partial file
+        cached_pdf = os.path.join(storage.ensure_dir(pdf_optimizer.PDF_CACHE_DIR), key + '.pdf')
+        handle, partial = tempfile.mkstemp(suffix='.tmp', dir=pdf_optimizer.PDF_CACHE_DIR)
+        os.close(handle)
+        shutil.copyfile(pdf_path, partial)
+        os.replace(partial, cached_pdf)
+        storage.track(cached_pdf, 'pdf_cache', cache_key=key)
+
+def render_document(template_path, context, output_dir, docx_name, pdf_name):
+    """
+    Render a template and context from cv_context or cover_letter_context into output_dir.
+    
+    Returns:
+    - Path of the PDF
+    """
+    # Ensure output directory exists
+    storage.ensure_dir(output_dir)
+    
+    pdf_path = os.path.join(output_dir, pdf_name)
+    render_pdf(template_path, context, os.path.join(output_dir, docx_name), pdf_path)
+    return pdf_path
+
+def cv_context(role):
+    """
+    Return the template path and render context of a CV.
+    """
+    return os.path.join('templates', 'cv.docx'), {'role': role}
+
 def generate_cv(role, output_dir='output'):
     """
     Generate a CV with the provided role.
     """
     try:
-        # Ensure output directory exists
-        if not os.path.exists(output_dir):
-            os.makedirs(output_dir)
-        
-        cv_template_path = os.path.join('templates', 'cv.docx')
-        cv_output_docx = os.path.join(output_dir, 'CV_temp.docx')
-        cv_output_pdf = os.path.join(output_dir, 'CV - Justin Isambert.pdf')
-        
-        # Create template object
-        doc = DocxTemplate(cv_template_path)
-        
-        # Render the template with context
-        context = {'role': role}
-        doc.render(context)
-        doc.save(cv_output_docx)
-        
-        # Initialize COM before calling Word automation
-        pythoncom.CoInitialize()
-        
-        # Convert to PDF
-        convert(cv_output_docx, cv_output_pdf)
-        
-        # Remove temporary docx file
-        os.remove(cv_output_docx)
+        # Render the template with context and convert to PDF
+        cv_output_pdf = render_document(*cv_context(role), output_dir, 'CV_temp.docx', CV_FILENAME)
         
         logger.info(f"Successfully generated CV for role: {role}")
         return cv_output_pdf
@@ -45,9 +159,6 @@ def generate_cv(role, output_dir='output'):
     except Exception as e:
         logger.error(f"Error generating CV: {str(e)}")
         raise
-    finally:
-        # Uninitialize COM
-        pythoncom.CoUninitialize()
 
 def get_current_date(language):
     """
@@ -78,81 +189,75 @@ def get_current_date(language):
         # Format: "January 11, 2023"
         return datetime.now().strftime("%B %d, %Y")
 
-def generate_cover_letter(language, job, company, output_dir='output', first_name='', last_name='', title='', formality='formal'):
+def cover_letter_template_path(language):
+    """Return the path of the cover letter template of a language"""
+    if language.lower() == 'french':
+        return os.path.join('templates', 'cover_letter_french.docx')
+    return os.path.join('templates', 'cover_letter_english.docx')
+
+def cover_letter_context(language, job, company, first_name='', last_name='', title='', formality='formal', date=None):
     """
-    Generate a cover letter based on the language and provided details.
+    Return the template path and render context of a cover letter.
+    
+    The date defaults to today formatted for the language; a batch passes it
+    in so the locale is switched once rather than once per letter.
     """
-    try:
-        # Ensure output directory exists
-        if not os.path.exists(output_dir):
-            os.makedirs(output_dir)
-        
-        # Determine which template to use based on language
-        if language.lower() == 'french':
-            template_path = os.path.join('templates', 'cover_letter_french.docx')
-            
-            # Set the appropriate salutation based on formality
-            if formality == 'formal' and title and last_name:
-                if title == 'Mr.':
-                    recipient_name = f"Cher M. {last_name}"
-                elif title == 'Ms.':
-                    recipient_name = f"Chère Mme. {last_name}"
-                else:
-                    recipient_name = f"Cher {last_name}"
-            elif formality == 'semi-formal' and first_name:
-                if title == 'Ms.':
-                    recipient_name = f"Chère {first_name}"
-                else:
-                    recipient_name = f"Cher {first_name}"
+    # Determine which template to use based on language
+    template_path = cover_letter_template_path(language)
+    if language.lower() == 'french':
+        # Set the appropriate salutation based on formality
+        if formality == 'formal' and title and last_name:
+            if title == 'Mr.':
+                recipient_name = f"Cher M. {last_name}"
+            elif title == 'Ms.':
+                recipient_name = f"Chère Mme. {last_name}"
             else:
-                recipient_name = "Madame, Monsieur"
-            
-            signature = None  # No signature for French version
-        else:
-            template_path = os.path.join('templates', 'cover_letter_english.docx')
-            
-            # Set the appropriate salutation based on formality
-            if formality == 'formal' and title and last_name:
-                recipient_name = f"Dear {title} {last_name}"
-                signature = "Yours sincerely"
-            elif formality == 'semi-formal' and first_name:
-                recipient_name = f"Dear {first_name}"
-                signature = "Yours sincerely"
+                recipient_name = f"Cher {last_name}"
+        elif formality == 'semi-formal' and first_name:
+            if title == 'Ms.':
+                recipient_name = f"Chère {first_name}"
             else:
-                recipient_name = "Dear Sir or Madam"
-                signature = "Yours faithfully"
-        
-        # Format output file names
-        cl_output_docx = os.path.join(output_dir, 'CL_temp.docx')
-        cl_output_pdf = os.path.join(output_dir, 'Cover Letter - Justin Isambert.pdf')
-        
-        # Create template object
-        doc = DocxTemplate(template_path)
-        
-        # Prepare context for template rendering
-        context = {
-            'date': get_current_date(language),
-            'job': job,
-            'company': company,
-            'name': recipient_name
-        }
-        
-        # Add signature for English version
-        if signature:
-            context['signature'] = signature
-        
-        # Render the template with context
-        doc.render(context)
-        doc.save(cl_output_docx)
-        
-        # Initialize COM before calling Word automation
-        pythoncom.CoInitialize()
-        
-        # Convert to PDF
-        convert(cl_output_docx, cl_output_pdf)
+                recipient_name = f"Cher {first_name}"
+        else:
+            recipient_name = "Madame, Monsieur"
         
-        # Remove temporary docx file
-        os.remove(cl_output_docx)
+        signature = None  # No signature for French version
+    else:
+        # Set the appropriate salutation based on formality
+        if formality == 'formal' and title and last_name:
+            recipient_name = f"Dear {title} {last_name}"
+            signature = "Yours sincerely"
+        elif formality == 'semi-formal' and first_name:
+            recipient_name = f"Dear {first_name}"
+            signature = "Yours sincerely"
+        else:
+            recipient_name = "Dear Sir or Madam"
+            signature = "Yours faithfully"
+    
+    # Prepare context for template rendering
+    context = {
+        'date': date or get_current_date(language),
+        'job': job,
+        'company': company,
+        'name': recipient_name
+    }
+    
+    # Add signature for English version
+    if signature:
+        context['signature'] = signature
+    
+    return template_path, context
+
+def generate_cover_letter(language, job, company, output_dir='output', first_name='', last_name='', title='', formality='formal'):
+    """
+    Generate a cover letter based on the language and provided details.
+    """
+    try:
+        # Render the template with context and convert to PDF
+        template_path, context = cover_letter_context(
+            language, job, company, first_name=first_name, last_name=last_name, title=title, formality=formality
+        )
+        cl_output_pdf = render_document(template_path, context, output_dir, 'CL_temp.docx', COVER_LETTER_FILENAME)
         
         logger.info(f"Successfully generated cover letter for {company}, job: {job}")
         return cl_output_pdf
@@ -160,9 +265,45 @@ def generate_cover_letter(language, job, company, output_dir='output', first_nam
     except Exception as e:
         logger.error(f"Error generating cover letter: {str(e)}")
         raise
-    finally:
-        # Uninitialize COM
-        pythoncom.CoUninitialize()
+
+def email_template_path(language):
+    """Return the path of the email template of a language"""
+    if language.lower() == 'french':
+        return os.path.join('templates', 'mail_french.txt')
+    return os.path.join('templates', 'mail_english.txt')
+
+def parse_email_template(template_path):
+    """
+    Read an email template and split it into its #OBJECT and #BODY sections.
+    
+    The file is read and checked once, then served from memory until it changes.
+    
+    Returns:
+    - Tuple of (object section, body section), with placeholders left in
+    
+    Raises:
+    - ValueError if the template does not have exactly one #OBJECT and one #BODY section
+    """
+    mtime = os.path.getmtime(template_path)
+    cached = _email_templates.get(template_path)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    
+    with open(template_path, 'r', encoding='utf-8') as file:
+        template_content = file.read()
+    
+    # Split the template into object and body sections
+    sections = template_content.split('#BODY')
+    if len(sections) != 2 or template_content.count('#OBJECT') != 1 or not sections[0].strip().startswith('#OBJECT'):
+        raise ValueError(f"Invalid email template format in {template_path}. Expected #OBJECT and #BODY sections.")
+    
+    object_section = sections[0].replace('#OBJECT', '').strip()
+    body_section = sections[1].strip()
+    if not object_section:
+        raise ValueError(f"Invalid email template format in {template_path}. The #OBJECT section is empty.")
+    
+    _email_templates[template_path] = (mtime, (object_section, body_section))
+    return object_section, body_section
 
 def get_email_template(language, job, role=None, first_name='', last_name='', title='', formality='formal'):
     """
@@ -170,9 +311,8 @@ def get_email_template(language, job, role=None, first_name='', last_name='', ti
     """
     try:
         # Determine which template to use based on language
+        template_path = email_template_path(language)
         if language.lower() == 'french':
-            template_path = os.path.join('templates', 'mail_french.txt')
-            
             # Set the appropriate salutation based on formality
             if formality == 'formal' and title and last_name:
                 if title == 'Mr.':
@@ -186,8 +326,6 @@ def get_email_template(language, job, role=None, first_name='', last_name='', ti
             else:
                 recipient_name = "Madame, Monsieur"
         else:  # English
-            template_path = os.path.join('templates', 'mail_english.txt')
-            
             # Set the appropriate salutation based on formality
             if formality == 'formal' and title and last_name:
                 recipient_name = f"Dear {title} {last_name}"
@@ -196,17 +334,7 @@ def get_email_template(language, job, role=None, first_name='', last_name='', ti
             else:
                 recipient_name = "Dear Sir or Madam"
         
-        # Read the template file
-        with open(template_path, 'r', encoding='utf-8') as file:
-            template_content = file.read()
-        
-        # Split the template into object and body sections
-        sections = template_content.split('#BODY')
-        if len(sections) != 2:
-            raise ValueError(f"Invalid email template format in {template_path}. Expected #OBJECT and #BODY sections.")
-        
-        object_section = sections[0].replace('#OBJECT', '').strip()
-        body_section = sections[1].strip()
+        object_section, body_section = parse_email_template(template_path)
         
         # Replace placeholders in both sections
         email_object = object_section.replace('{{ name }}', recipient_name).replace('{{ job }}', job)
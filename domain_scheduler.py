@@ -0,0 +1,80 @@
+import logging
+from collections import OrderedDict, deque
+
+# Setup logging
+logger = logging.getLogger(__name__)
+
+# Records sent back to back to one domain before the next domain gets a turn
+DEFAULT_GROUP_SIZE = 20
+
+# Records buffered to find groups, bounding memory on large cursors
+DEFAULT_WINDOW = 500
+
+# Connections and sends in flight at once to a single domain
+DEFAULT_DOMAIN_CONCURRENCY = 2
+
+def recipient_domain(email):
+    """Return the lower-cased domain of an email address, or an empty string"""
+    if not email or '@' not in email:
+        return ''
+    return email.rsplit('@', 1)[1].strip().lower()
+
+def record_domain(record):
+    """Return the recipient domain of a database record, or an empty string if it has none"""
+    try:
+        return recipient_domain(record['email'])
+    except Exception:
+        return ''
+
+def group_by_domain(items, domain_of, group_size=DEFAULT_GROUP_SIZE, window=DEFAULT_WINDOW):
+    """
+    Reorder items into groups sharing a recipient domain (or any other key,
+    such as a sender account and domain pair).
+
+    Up to `window` items are buffered per domain. Whenever the buffer is
+    full, the next domain in rotation hands out a group of at most
+    `group_size` items, so one large domain cannot starve the others.
+
+    Parameters:
+    - items: Iterable of items, consumed lazily
+    - domain_of: Callable returning the domain or group key of an item
+    - group_size: Maximum number of items per group
+    - window: Maximum number of items buffered at once
+
+    Yields:
+    - Tuples of (domain, list of items)
+    """
+    group_size = max(1, int(group_size))
+    window = max(group_size, int(window))
+    buckets = OrderedDict()
+    rotation = deque()
+    buffered = 0
+
+    def next_group():
+        nonlocal buffered
+        domain = rotation.popleft()
+        bucket = buckets[domain]
+        group = bucket[:group_size]
+        del bucket[:group_size]
+        buffered -= len(group)
+
+        # Domains with items left go to the back of the rotation
+        if bucket:
+            rotation.append(domain)
+        else:
+            del buckets[domain]
+        return domain, group
+
+    for item in items:
+        domain = domain_of(item)
+        if domain not in buckets:
+            buckets[domain] = []
+            rotation.append(domain)
+        buckets[domain].append(item)
+        buffered += 1
+
+        if buffered >= window:
+            yield next_group()
+
+    while rotation:
+        yield next_group()
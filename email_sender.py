@@ -1,12 +1,24 @@
 import os
+import hashlib
 import logging
-import win32com.client
 import subprocess
+import threading
 import time
-import pythoncom
 import psutil
-from document_processor import generate_cv, generate_cover_letter, get_email_template
-from database import mark_as_processed
+
+try:
+    import win32com.client
+    import pythoncom
+except ImportError:  # Outlook automation is only available on Windows
+    win32com = None
+    pythoncom = None
+from document_processor import render_document, CV_FILENAME, COVER_LETTER_FILENAME
+from preflight import extract_record_fields, plan_email, preflight
+from database import claim_record, release_claim, begin_send, complete_send, fail_send, get_ledger_status
+from rate_limiter import RateLimiter, DEFAULT_RATE_PER_MINUTE
+from retry_scheduler import RetryPolicy, RetryQueue, register_failure
+from storage import ensure_dir, track
+from domain_scheduler import record_domain, group_by_domain, DEFAULT_GROUP_SIZE, DEFAULT_WINDOW
 
 # Setup logging
 logger = logging.getLogger(__name__)
@@ -15,7 +27,11 @@ logger = logging.getLogger(__name__)
 OUTLOOK_CLASSIC_PATH = r"C:\Program Files\Microsoft Office\root\Office16\OUTLOOK.EXE"
 
 # Outlook account settings
-OUTLOOK_ACCOUNT = "justin.isambert@edhec.com"
+OUTLOOK_ACCOUNT = os.environ.get("OUTLOOK_ACCOUNT", "justin.isambert@edhec.com")
+
+# There is one single-threaded Outlook instance, and send_email may restart it,
+# so Outlook sends from several threads go out one at a time
+OUTLOOK_LOCK = threading.Lock()
 
 def is_new_outlook_running():
     """Check if the new version of Outlook (olk.exe) is running"""
@@ -67,7 +83,7 @@ def start_outlook_classic():
         logger.error(f"Error starting Outlook Classic: {str(e)}")
         return False
 
-def send_email(to_email, subject, body, attachments=None):
+def send_email(to_email, subject, body, attachments=None, account=OUTLOOK_ACCOUNT):
     """
     Send an email using Outlook Classic with specific account.
     
@@ -76,10 +92,15 @@ def send_email(to_email, subject, body, attachments=None):
     - subject: Subject line of the email
     - body: Body text of the email
     - attachments: List of file paths to attach
+    - account: Display name of the Outlook account to send from
     
     Returns:
     - True if successful, False otherwise
     """
+    if win32com is None:
+        logger.error("Outlook automation requires pywin32, use another transport on this platform")
+        return False
+    
     try:
         # Close Outlook New if it's running
         close_new_outlook()
@@ -95,19 +116,19 @@ def send_email(to_email, subject, body, attachments=None):
         namespace = outlook.GetNamespace("MAPI")
         
         # Get the specific account
-        for account in namespace.Accounts:
-            if account.DisplayName == OUTLOOK_ACCOUNT:
-                logger.info(f"Using Outlook account: {OUTLOOK_ACCOUNT}")
+        for outlook_account in namespace.Accounts:
+            if outlook_account.DisplayName == account:
+                logger.info(f"Using Outlook account: {account}")
                 break
         else:
-            logger.error(f"Could not find Outlook account: {OUTLOOK_ACCOUNT}")
+            logger.error(f"Could not find Outlook account: {account}")
             return False
         
         # Create mail item
         mail = outlook.CreateItem(0)  # 0 = olMailItem
         
         # Set the sending account
-        mail._oleobj_.Invoke(*(64209, 0, 8, 0, account))  # Set the SendUsingAccount property
+        mail._oleobj_.Invoke(*(64209, 0, 8, 0, outlook_account))  # Set the SendUsingAccount property
         
         # Set email properties
         mail.To = to_email
@@ -126,7 +147,7 @@ def send_email(to_email, subject, body, attachments=None):
         # Send the email
         mail.Send()
         
-        logger.info(f"Email sent to {to_email} using account {OUTLOOK_ACCOUNT}")
+        logger.info(f"Email sent to {to_email} using account {account}")
         return True
     
     except Exception as e:
@@ -136,106 +157,299 @@ def send_email(to_email, subject, body, attachments=None):
         # Uninitialize COM
         pythoncom.CoUninitialize()
 
-def process_single_record(record, output_dir='output'):
+class OutlookTransport:
+    """
+    Transport adapter around send_email so Outlook can be driven like the
+    other transports (connect / send / close).
+    
+    Sends are serialised across every OutlookTransport (see OUTLOOK_LOCK).
+    """
+    
+    def __init__(self, account=OUTLOOK_ACCOUNT):
+        self.account = account
+    
+    def connect(self):
+        """Outlook is started on demand by send_email"""
+        return None
+    
+    def send(self, to_email, subject, body, attachments=None):
+        with OUTLOOK_LOCK:
+            return send_email(to_email, subject, body, attachments, account=self.account)
+    
+    def close(self):
+        return None
+
+def skip_result(fields):
+    """
+    Return a skipped result for records that must not be sent, or None.
+    """
+    record_id = fields['id']
+    
+    # Skip already processed records
+    if fields['processed']:
+        logger.info(f"Skipping already processed record ID: {record_id}")
+        return {"id": record_id, "status": "skipped", "message": "Already processed"}
+    
+    # Dead-letter records are only retried once the record is edited
+    if fields['state'] == 'dead':
+        logger.info(f"Skipping dead-letter record ID: {record_id}")
+        return {"id": record_id, "status": "skipped", "message": "Dead letter, edit the record to retry"}
+    
+    return None
+
+def message_key(fields):
+    """
+    Return the idempotency key of the message built from a record.
+    
+    The key only changes when the content of the record changes, so the same
+    application is never sent twice.
+    """
+    parts = [fields['id'], fields['email'], fields['english_job'], fields['french_job'], fields['company'],
+             fields['first_name'], fields['last_name'], fields['title'], fields['formality'], fields['role'],
+             fields['cover_letter_language'], fields['email_language']]
+    return hashlib.sha256('\x1f'.join(str(part or '') for part in parts).encode('utf-8')).hexdigest()
+
+def duplicate_result(fields, key):
+    """
+    Build the result for a message the ledger refused to send again.
+    
+    A message already sent by an earlier run that crashed before marking the
+    record is reconciled here. Otherwise the claim is released, so the record
+    does not stay in the sending state.
+    """
+    record_id = fields['id']
+    status = get_ledger_status(key)
+    
+    if status == 'sent':
+        complete_send(key, record_id)
+        logger.info(f"Record ID: {record_id} was already sent, not sending again")
+        return {"id": record_id, "status": "skipped", "message": "Already sent"}
+    
+    release_claim(record_id)
+    if status == 'unknown':
+        logger.warning(f"Record ID: {record_id} may already have been sent, edit the record to send it again")
+        return {"id": record_id, "status": "skipped", "message": "May already have been sent, edit the record to retry"}
+    
+    logger.warning(f"Record ID: {record_id} is already being sent, not sending again")
+    return {"id": record_id, "status": "skipped", "message": "Already being sent"}
+
+def render_email(fields, output_dir='output', plan=None):
+    """
+    Generate the attachments and the email text for a record.
+    
+    Parameters:
+    - fields: Record fields as returned by extract_record_fields
+    - output_dir: Directory to store generated files
+    - plan: Render plan from the pre-flight check (resolved here when not given)
+    
+    Returns:
+    - Tuple of (subject, body, attachments)
+    """
+    plan = plan or plan_email(fields)
+    
+    # Generate documents
+    cv_path = render_document(*plan['cv'], output_dir, 'CV_temp.docx', CV_FILENAME)
+    cover_letter_path = render_document(*plan['cover_letter'], output_dir, 'CL_temp.docx', COVER_LETTER_FILENAME)
+    track(cv_path, 'cv', contact_id=fields['id'])
+    track(cover_letter_path, 'cover_letter', contact_id=fields['id'])
+    
+    return plan['subject'], plan['body'], [cv_path, cover_letter_path]
+
+def process_single_record(record, output_dir='output', policy=None):
     """
     Process a single record from the database and send an email.
     
     Parameters:
     - record: Database record to process
     - output_dir: Directory to store generated files
+    - policy: RetryPolicy for backoff and dead-letter decisions
     
     Returns:
     - Result dictionary with status information
     """
-    try:
-        record_id = record['id']
-        email = record['email']
-        
-        # Get language-specific job titles
-        english_job = record['english_job'] if 'english_job' in record.keys() else record['job'] 
-        french_job = record['french_job'] if 'french_job' in record.keys() else record['job']
-        
-        company = record['company']
-        first_name = record['first_name'] if 'first_name' in record.keys() else ''
-        last_name = record['last_name'] if 'last_name' in record.keys() else ''
-        title = record['title'] if 'title' in record.keys() else ''
-        formality = record['formality'] if 'formality' in record.keys() else 'formal'
-        role = record['role']
-        cover_letter_language = record['cover_letter_language']
-        email_language = record['email_language']
-        processed = record['processed']
-        
-        # Skip already processed records
-        if processed:
-            logger.info(f"Skipping already processed record ID: {record_id}")
-            return {"id": record_id, "status": "skipped", "message": "Already processed"}
-        
-        logger.info(f"Processing record ID: {record_id}, email: {email}")
-        
-        # Use the appropriate job title based on language
-        job_for_cover_letter = english_job if cover_letter_language == 'english' else french_job
-        job_for_email = english_job if email_language == 'english' else french_job
-        
-        # Generate documents
-        cv_path = generate_cv(role, output_dir)
-        cover_letter_path = generate_cover_letter(
-            cover_letter_language, job_for_cover_letter, company, output_dir=output_dir,
-            first_name=first_name, last_name=last_name, title=title, formality=formality
-        )
-        
-        # Get email content with subject and body using email_language
-        email_subject, email_body = get_email_template(
-            email_language, job_for_email, role, 
-            first_name=first_name, last_name=last_name, title=title, formality=formality
-        )
-        
-        # Send email with attachments
-        attachments = [cv_path, cover_letter_path]
-        email_sent = send_email(email, email_subject, email_body, attachments)
-        
-        if email_sent:
-            # Mark record as processed
-            mark_as_processed(record_id)
-            result = {"id": record_id, "status": "success", "message": "Email sent successfully"}
-            logger.info(f"Successfully processed record ID: {record_id}")
-        else:
-            result = {"id": record_id, "status": "error", "message": "Failed to send email"}
-            logger.error(f"Failed to send email for record ID: {record_id}")
-        
-        return result
-    
-    except Exception as e:
-        logger.error(f"Error processing record: {str(e)}")
-        try:
-            record_id = record['id'] if record and 'id' in record.keys() else 'unknown'
-        except:
-            record_id = 'unknown'
-        return {"id": record_id, "status": "error", "message": str(e)}
+    return send_records([record], output_dir, policy=policy)[0]
 
-def process_email_queue(records, output_dir='output'):
+def send_records(records, output_dir='output', send=send_email, policy=None, limiter=None, accounts=None, should_stop=None,
+                 plans=None, group_size=DEFAULT_GROUP_SIZE, domain_rate_per_minute=None):
     """
-    Process records from the database and send emails.
+    Send records with retries, rendering each record only once.
+    
+    Each record is claimed atomically before rendering, so overlapping
+    batches never send the same record. Every message goes through the send
+    ledger under its idempotency key, which stops a message from going out
+    twice even across crashes.
+    
+    A failed send is retried with exponential backoff while the following
+    records keep going. The rendered attachments are kept for the retries,
+    and every attempt (first try or retry) goes through the same rate limiter.
+    
+    Records are reordered into groups sharing a recipient domain, sent back
+    to back over the same connection, with domains taking turns (see
+    domain_scheduler.group_by_domain). Results keep the input order.
     
     Parameters:
-    - records: List of database records to process
+    - records: Iterable of database records to process
     - output_dir: Directory to store generated files
+    - send: Callable with the signature of send_email
+    - policy: RetryPolicy for backoff and dead-letter decisions
+    - limiter: RateLimiter pacing every attempt
+    - accounts: AccountPool spreading the records across sender accounts,
+      each sending with its own transport and rate limit (send is then unused)
+    - should_stop: Callable returning True once the batch should stop early.
+      The message being sent is finished, no further record is started and
+      records waiting for a retry go back to pending for a later batch.
+    - plans: Dictionary of record ID to render plan, from the pre-flight check; each plan is removed once used
+    - group_size: Records per domain group (0 keeps the input order)
+    - domain_rate_per_minute: Send rate per recipient domain (None for no per-domain limit)
     
     Returns:
-    - List of results for each record processed
+    - List of results for each record processed, in input order
     """
-    results = []
+    policy = policy or RetryPolicy()
+    # With sender accounts, each account's own limiter sets the pace
+    limiter = limiter or RateLimiter(None if accounts else DEFAULT_RATE_PER_MINUTE)
+    retries = RetryQueue()
+    results = {}
+    transports = {}
+    domain_limiters = {}
     
-    # Ensure output directory exists
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
+    def domain_limiter(fields):
+        if not domain_rate_per_minute:
+            return None
+        domain = record_domain(fields)
+        if domain not in domain_limiters:
+            domain_limiters[domain] = RateLimiter(domain_rate_per_minute)
+        return domain_limiters[domain]
     
-    for record in records:
+    def sender_for(account):
+        if account is None:
+            return send
+        if account.name not in transports:
+            transports[account.name] = account.make_transport()
+        account.limiter.acquire()
+        return transports[account.name].send
+    
+    def fail(index, job, error):
+        fields, account, key = job[:3]
+        record_id = fields['id']
+        
+        fail_send(key, error)
+        attempts, dead = register_failure(record_id, error, policy)
+        # Failures slow the limiter down so retries cannot spike the send rate
+        limiter.penalize()
+        if account:
+            account.limiter.penalize()
+        if domain_limiter(fields):
+            domain_limiter(fields).penalize()
+        
+        if dead:
+            if account:
+                accounts.release(account)
+            results[index] = {"id": record_id, "status": "error",
+                              "message": f"{error} after {attempts} attempts, moved to dead letter"}
+            logger.error(f"{error} for record ID: {record_id}, moved to dead letter")
+        else:
+            delay = policy.delay(attempts)
+            results[index] = {"id": record_id, "status": "error", "message": error}
+            logger.warning(f"{error} for record ID: {record_id}, retrying in {delay:.1f}s")
+            retries.schedule(delay, (index, job))
+    
+    def attempt(index, job):
+        fields, account, key, email_subject, email_body, attachments = job
+        record_id = fields['id']
+        sent = False
+        
         try:
-            result = process_single_record(record, output_dir)
-            results.append(result)
+            limiter.acquire()
+            if domain_limiter(fields):
+                domain_limiter(fields).acquire()
+            account_send = sender_for(account)
+            if not begin_send(key, record_id, fields['email']):
+                if account:
+                    accounts.release(account)
+                results[index] = duplicate_result(fields, key)
+                return
             
-            # Add a small delay between emails to avoid rate limiting
-            time.sleep(2)
+            sent = account_send(fields['email'], email_subject, email_body, attachments)
+            if sent:
+                complete_send(key, record_id)
+                results[index] = {"id": record_id, "status": "success", "message": "Email sent successfully"}
+                logger.info(f"Successfully processed record ID: {record_id}")
+                return
+            
+            fail(index, job, "Failed to send email")
+        
+        except Exception as e:
+            logger.error(f"Error sending record ID {record_id}: {str(e)}")
+            if sent:
+                # The message went out: never send it again. The ledger row stays
+                # 'sending', which start-up recovery reports for a manual check.
+                results[index] = {"id": record_id, "status": "error",
+                                  "message": f"Email sent but not recorded: {str(e)}"}
+                return
+            
+            # A transport or database error counts as a failed attempt, retried like one
+            try:
+                fail(index, job, f"Error sending email: {str(e)}")
+            except Exception as failure:
+                logger.error(f"Could not record the failure of record ID {record_id}: {str(failure)}")
+                release_claim(record_id)
+                if account:
+                    accounts.release(account)
+                results[index] = {"id": record_id, "status": "error", "message": str(e)}
+    
+    entries = enumerate(records)
+    if group_size:
+        groups = group_by_domain(entries, lambda entry: record_domain(entry[1]), group_size, DEFAULT_WINDOW)
+        entries = (entry for _, group in groups for entry in group)
+    
+    for handled, (index, record) in enumerate(entries):
+        if should_stop and should_stop():
+            logger.warning(f"Stopping the batch early, {handled} records handled")
+            break
+        
+        # Retries that became due go before the next new record
+        for item in retries.pop_due():
+            attempt(*item)
+        
+        try:
+            fields = extract_record_fields(record)
+            plan = (plans or {}).pop(fields['id'], None)
+            skipped = skip_result(fields)
+            if skipped:
+                results[index] = skipped
+                continue
+            
+            # One statement per record; a record claimed elsewhere is left alone
+            if not claim_record(fields['id']):
+                logger.info(f"Skipping record ID: {fields['id']}, claimed by another batch")
+                results[index] = {"id": fields['id'], "status": "skipped", "message": "Already being sent"}
+                continue
+            
+            account = None
+            if accounts:
+                account, reason = accounts.acquire(fields)
+                if account is None:
+                    # The record stays pending for a later batch
+                    release_claim(fields['id'])
+                    logger.info(f"Deferring record ID: {fields['id']}, {reason}")
+                    results[index] = {"id": fields['id'], "status": "skipped", "message": reason}
+                    continue
+            
+            logger.info(f"Processing record ID: {fields['id']}, email: {fields['email']}"
+                        + (f", sender account: {account.name}" if account else ""))
+            
+            # Render into a per-record directory so the attachments survive until the retries are done
+            record_dir = os.path.join(output_dir, str(fields['id']))
+            try:
+                rendered = render_email(fields, record_dir, plan)
+            except Exception:
+                release_claim(fields['id'])
+                if account:
+                    accounts.release(account)
+                raise
+            
+            attempt(index, (fields, account, message_key(fields)) + rendered)
         
         except Exception as e:
             logger.error(f"Error processing record: {str(e)}")
@@ -243,35 +457,75 @@ def process_email_queue(records, output_dir='output'):
                 record_id = record['id'] if record and 'id' in record.keys() else 'unknown'
             except:
                 record_id = 'unknown'
-            results.append({"id": record_id, "status": "error", "message": str(e)})
+            results[index] = {"id": record_id, "status": "error", "message": str(e)}
     
-    return results
+    # Drain the remaining retries
+    while retries and not (should_stop and should_stop()):
+        # Wake up regularly to notice a stop request during long backoffs
+        retries.wait(1 if should_stop else None)
+        for item in retries.pop_due():
+            attempt(*item)
+    
+    # When stopped early, records still waiting for a retry are left to a later batch
+    for index, job in retries.pop_all():
+        fields, account = job[0], job[1]
+        release_claim(fields['id'])
+        if account:
+            accounts.release(account)
+    
+    for transport in transports.values():
+        try:
+            transport.close()
+        except Exception as e:
+            logger.error(f"Error closing transport: {str(e)}")
+    
+    return [results[index] for index in sorted(results)]
 
-def send_selected_emails(selected_records, output_dir='output'):
+def process_email_queue(records, output_dir='output', **options):
     """
-    Process selected records from the database and send emails.
+    Process records from the database and send emails.
+    
+    The pre-flight check runs first, so rows that cannot be sent are
+    reported before anything is rendered.
     
     Parameters:
-    - selected_records: List of specific database records to process
+    - records: List of database records to process, or a callable returning
+      a fresh cursor over them (see preflight)
     - output_dir: Directory to store generated files
+    - options: Keyword options of send_records (send, policy, limiter, accounts, should_stop)
     
     Returns:
-    - List of result dictionaries with status information
+    - List of results for each record processed, the rows failing the pre-flight check first
     """
-    results = []
+    # Ensure output directory exists
+    ensure_dir(output_dir)
     
-    try:
-        # Process each record
-        for record in selected_records:
-            result = process_single_record(record, output_dir)
-            results.append(result)
-            
-            # If an error occurred, log it but continue processing
-            if result['status'] == 'error':
-                logger.error(f"Error processing record ID {result['id']}: {result['message']}")
-        
-        return results
+    report = preflight(records)
+    results = send_records(report['records'], output_dir, plans=report['plans'], **options)
+    # Read after sending: rows edited into a bad state during the batch are added late
+    return report['invalid'] + results
+
+def send_selected_emails(selected_records, output_dir='output', **options):
+    """
+    Process selected records from the database and send emails, after the pre-flight check.
     
-    except Exception as e:
-        logger.error(f"Error processing selected emails: {str(e)}")
-        return results 
\ No newline at end of file
+    Parameters:
+    - selected_records: List of specific database records to process, or a
+      callable returning a fresh cursor over them (see preflight)
+    - output_dir: Directory to store generated files
+    - options: Keyword options of send_records (send, policy, limiter, accounts, should_stop)
+    
+    Returns:
+    - List of result dictionaries with status information, the rows failing the pre-flight check first
+    """
+    report = preflight(selected_records)
+    results = send_records(report['records'], output_dir, plans=report['plans'], **options)
+    # Read after sending: rows edited into a bad state during the batch are added late
+    results = report['invalid'] + results
+    
+    # If an error occurred, log it
+    for result in results:
+        if result['status'] == 'error':
+            logger.error(f"Error processing record ID {result['id']}: {result['message']}")
+    
+    return results
\ No newline at end of file
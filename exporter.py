@@ -0,0 +1,83 @@
+import io
+import sys
+import csv
+import json
+import logging
+import argparse
+from database import init_db, iter_export_rows, EXPORT_TABLES, SEARCH_FACETS
+from logging_config import setup_logging
+
+# Setup logging
+logger = logging.getLogger(__name__)
+
+# Supported export formats and their content types
+EXPORT_FORMATS = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+
+# Rows encoded per chunk of output
+DEFAULT_CHUNK_SIZE = 500
+
+def export_rows(table, export_format, query='', filters=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Stream a table as CSV or NDJSON text.
+    
+    Parameters:
+    - table: Name of a table in EXPORT_TABLES
+    - export_format: 'csv' or 'ndjson'
+    - query, filters: Search restricting exported contacts
+    - chunk_size: Rows per yielded chunk
+    
+    Yields:
+    - Chunks of text, the CSV header first
+    """
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format: {export_format}")
+    
+    rows = iter_export_rows(table, query, filters, chunk_size)
+    columns = next(rows)
+    buffer = io.StringIO()
+    writer = csv.writer(buffer) if export_format == 'csv' else None
+    if writer:
+        writer.writerow(columns)
+    
+    count = 0
+    for row in rows:
+        if writer:
+            writer.writerow(row)
+        else:
+            buffer.write(json.dumps(dict(zip(columns, row)), ensure_ascii=False) + '\n')
+        count += 1
+        
+        if count % chunk_size == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    
+    yield buffer.getvalue()
+    logger.info(f"Exported {count} rows of {table} as {export_format}")
+
+def main():
+    parser = argparse.ArgumentParser(description='Export contacts or the send ledger as CSV or NDJSON.')
+    parser.add_argument('table', choices=sorted(EXPORT_TABLES))
+    parser.add_argument('--format', choices=sorted(EXPORT_FORMATS), default='csv')
+    parser.add_argument('--output', help='File to write (default: standard output)')
+    parser.add_argument('--q', default='', help='Search query restricting exported contacts')
+    for name in SEARCH_FACETS:
+        parser.add_argument(f'--{name}', default='', help=f'Only export contacts with this {name}')
+    args = parser.parse_args()
+    
+    setup_logging()
+    init_db()
+    filters = {name: getattr(args, name) for name in SEARCH_FACETS}
+    output = open(args.output, 'w', encoding='utf-8', newline='') if args.output else sys.stdout
+    try:
+        for chunk in export_rows(args.table, args.format, args.q, filters):
+            output.write(chunk)
+    finally:
+        if args.output:
+            output.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,33 @@
+"""
+Production settings for gunicorn, read by `gunicorn wsgi:app`.
+
+Every setting can be overridden with its environment variable.
+"""
+import os
+import multiprocessing
+
+bind = os.environ.get('BIND', '127.0.0.1:8000')
+
+# Worker processes, each serving several requests at once with threads.
+# SQLite takes one writer at a time, so more workers mostly help reads.
+workers = int(os.environ.get('WEB_WORKERS', min(2 * multiprocessing.cpu_count() + 1, 8)))
+worker_class = 'gthread'
+threads = int(os.environ.get('WEB_THREADS', '4'))
+
+# Import the app once in the master before forking, so start-up work
+# (database migration, claim recovery) runs once
+preload_app = True
+
+# Requests only queue sends, so none should take long
+timeout = int(os.environ.get('WEB_TIMEOUT', '60'))
+# On SIGTERM, workers finish the requests in flight for up to this many seconds
+graceful_timeout = int(os.environ.get('WEB_GRACEFUL_TIMEOUT', '30'))
+keepalive = 5
+
+# Restart workers now and then so a leak cannot grow forever
+max_requests = 1000
+max_requests_jitter = 100
+
+# Request and error logs go to the console, collected by the process manager
+accesslog = '-'
+errorlog = '-'
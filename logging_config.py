@@ -1,4 +1,5 @@
 import os
+import sys
 import logging
 from logging.handlers import RotatingFileHandler
 
@@ -11,7 +12,7 @@ def setup_logging():
         try:
             os.makedirs(log_dir, exist_ok=True)
         except Exception as e:
-            print(f"Warning: Could not create logs directory: {str(e)}")
+            print(f"Warning: Could not create logs directory: {str(e)}", file=sys.stderr)
             return
 
     # Configure root logger
@@ -44,10 +45,11 @@ def setup_logging():
         console_handler.setFormatter(file_formatter)
         root_logger.addHandler(console_handler)
         
-        print(f"Logging configured successfully to {log_file}")
+        # On stderr, so command-line tools can write their results to stdout
+        print(f"Logging configured successfully to {log_file}", file=sys.stderr)
         
     except Exception as e:
-        print(f"Error setting up logging: {str(e)}")
+        print(f"Error setting up logging: {str(e)}", file=sys.stderr)
         # Fallback to console-only logging
         console_handler = logging.StreamHandler()
         console_formatter = logging.Formatter(
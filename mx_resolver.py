@@ -0,0 +1,104 @@
+import os
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import dns.resolver
+except ImportError:
+    dns = None
+
+# Setup logging
+logger = logging.getLogger(__name__)
+
+# Name server for MX lookups as host or host:port, the system resolver when empty
+DNS_SERVER = os.environ.get('DNS_SERVER', '')
+
+# How long resolved and failed lookups are cached, in seconds
+DEFAULT_MX_TTL = 3600
+DEFAULT_NEGATIVE_TTL = 300
+
+def query_mx(domain, nameserver=DNS_SERVER, timeout=5.0):
+    """
+    Look up the mail exchangers of a domain.
+
+    Parameters:
+    - domain: Recipient domain
+    - nameserver: Name server as host or host:port (system resolver when empty)
+    - timeout: Seconds before the lookup is given up
+
+    Returns:
+    - List of mail exchanger host names, most preferred first. The domain
+      itself (its implicit MX) when it has no MX record or dnspython is not installed.
+    """
+    if dns is None:
+        return [domain]
+
+    resolver = dns.resolver.Resolver(configure=not nameserver)
+    if nameserver:
+        host, _, port = nameserver.partition(':')
+        resolver.nameservers = [host]
+        resolver.port = int(port or 53)
+    resolver.lifetime = timeout
+
+    try:
+        answer = resolver.resolve(domain, 'MX')
+    except dns.resolver.NoAnswer:
+        return [domain]
+
+    records = sorted(answer, key=lambda record: record.preference)
+    return [str(record.exchange).rstrip('.') for record in records]
+
+class MxCache:
+    """
+    Thread-safe cache of MX lookups with a time to live.
+
+    Failed lookups are cached for a shorter time, so a run with many
+    contacts at one broken domain queries it once instead of per record.
+    """
+
+    def __init__(self, resolver=query_mx, ttl=DEFAULT_MX_TTL, negative_ttl=DEFAULT_NEGATIVE_TTL, clock=time.monotonic):
+        """
+        Parameters:
+        - resolver: Callable taking a domain and returning its mail exchangers
+        - ttl: Seconds a successful lookup is reused
+        - negative_ttl: Seconds a failed lookup is reused
+        - clock: Monotonic clock, replaceable in tests
+        """
+        self.resolver = resolver
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def resolve(self, domain):
+        """Return the mail exchangers of a domain, an empty list if the lookup failed"""
+        domain = domain.lower()
+        with self._lock:
+            entry = self._entries.get(domain)
+            if entry and entry[1] > self.clock():
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+
+        # Resolve outside the lock so one slow domain does not hold up the others
+        try:
+            hosts, ttl = list(self.resolver(domain)), self.ttl
+        except Exception as e:
+            logger.warning(f"MX lookup failed for {domain}: {str(e)}")
+            hosts, ttl = [], self.negative_ttl
+
+        with self._lock:
+            self._entries[domain] = (hosts, self.clock() + ttl)
+        return hosts
+
+    def prefetch(self, domains, workers=8):
+        """Resolve several domains in parallel ahead of sending"""
+        domains = {domain.lower() for domain in domains}
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='mx') as executor:
+            list(executor.map(self.resolve, domains))
+        return len(domains)
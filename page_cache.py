@@ -0,0 +1,107 @@
+import hashlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+from functools import wraps
+from flask import request, session, make_response
+from database import get_data_version
+
+# Setup logging
+logger = logging.getLogger(__name__)
+
+# Rendered pages kept per process
+DEFAULT_MAX_ENTRIES = 128
+
+def build_token():
+    """
+    Return a token that changes whenever the code or templates are deployed.
+
+    It is the newest modification time of the Python modules and templates
+    next to this file, so every worker of a deployment computes the same one.
+    """
+    root = os.path.dirname(os.path.abspath(__file__))
+    paths = [os.path.join(root, name) for name in os.listdir(root) if name.endswith('.py')]
+    for folder, _, files in os.walk(os.path.join(root, 'templates')):
+        paths.extend(os.path.join(folder, name) for name in files)
+    return str(max((os.path.getmtime(path) for path in paths), default=0))
+
+BUILD_TOKEN = build_token()
+
+class PageCache:
+    """
+    Least recently used cache of rendered responses.
+
+    Entries are keyed on the request and the contacts data version, so any
+    write to the contacts makes the old entries unreachable; they then age
+    out of the cache.
+    """
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+page_cache = PageCache()
+
+def cached_page(view):
+    """
+    Serve GET requests of a view from page_cache, with ETag revalidation.
+
+    The ETag is derived from the build token, the data version and the URL,
+    so a deploy with new code or templates invalidates it, and a browser
+    revalidating an unchanged page gets a 304 without the page being
+    rendered or searched. Requests with pending flash messages bypass the
+    cache, since the messages are part of the page.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if request.method != 'GET' or session.get('_flashes'):
+            return view(*args, **kwargs)
+
+        version = get_data_version()
+        url = request.full_path
+        etag = hashlib.sha1(f"{BUILD_TOKEN}:{version}:{url}".encode('utf-8')).hexdigest()
+
+        if etag in request.if_none_match:
+            response = make_response('', 304)
+        else:
+            entry = page_cache.get((url, version))
+            if entry is None:
+                rendered = make_response(view(*args, **kwargs))
+                if rendered.status_code != 200:
+                    return rendered
+                entry = (rendered.get_data(), rendered.mimetype)
+                page_cache.put((url, version), entry)
+            response = make_response(entry[0])
+            response.mimetype = entry[1]
+
+        response.set_etag(etag)
+        # Browsers must revalidate, which is cheap thanks to the ETag
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+
+    return wrapper
@@ -0,0 +1,285 @@
+"""
+Pre-flight checks run before a batch renders or sends anything.
+
+Templates are validated once per batch, then every pending record is
+checked in a first pass, so bad rows are reported before anything is
+rendered instead of failing halfway through the pipeline after a CV was
+already converted. A second pass streams the good rows with their render
+plan (template paths, contexts and email text).
+
+Dry run over the pending contacts, without rendering, sending or writing:
+
+    python preflight.py
+"""
+import os
+import re
+import logging
+import argparse
+from docxtpl import DocxTemplate
+from document_processor import (cv_context, cover_letter_context, cover_letter_template_path, email_template_path,
+                                parse_email_template, get_email_template, get_current_date)
+from database import init_db, get_all_records, record_preflight_errors
+from logging_config import setup_logging
+
+# Setup logging
+logger = logging.getLogger(__name__)
+
+# Languages with a cover letter and an email template
+LANGUAGES = ('english', 'french')
+
+# Placeholders filled in the email templates, written exactly like this
+EMAIL_PLACEHOLDERS = ('{{ name }}', '{{ job }}')
+
+def extract_record_fields(record):
+    """
+    Read the fields needed to build an email from a database record.
+
+    Parameters:
+    - record: Database record (sqlite3.Row or dict)
+
+    Returns:
+    - Dictionary of record fields with defaults for legacy columns
+    """
+    return {
+        "id": record['id'],
+        "email": record['email'],
+        # Get language-specific job titles
+        "english_job": record['english_job'] if 'english_job' in record.keys() else record['job'],
+        "french_job": record['french_job'] if 'french_job' in record.keys() else record['job'],
+        "company": record['company'],
+        "first_name": record['first_name'] if 'first_name' in record.keys() else '',
+        "last_name": record['last_name'] if 'last_name' in record.keys() else '',
+        "title": record['title'] if 'title' in record.keys() else '',
+        "formality": record['formality'] if 'formality' in record.keys() else 'formal',
+        "role": record['role'],
+        "cover_letter_language": record['cover_letter_language'],
+        "email_language": record['email_language'],
+        "processed": record['processed'],
+        "state": record['state'] if 'state' in record.keys() else ('sent' if record['processed'] else 'pending'),
+    }
+
+def _docx_problem(template_path, context):
+    if not os.path.exists(template_path):
+        return f"Template {template_path} is missing"
+    try:
+        unfilled = DocxTemplate(template_path).get_undeclared_template_variables() - set(context)
+    except Exception as e:
+        return f"Template {template_path} cannot be read: {str(e)}"
+    if unfilled:
+        return f"Template {template_path} uses variables that are never filled: {', '.join(sorted(unfilled))}"
+    return None
+
+def _email_problem(template_path):
+    if not os.path.exists(template_path):
+        return f"Template {template_path} is missing"
+    try:
+        object_section, body_section = parse_email_template(template_path)
+    except ValueError as e:
+        return str(e)
+    # Placeholders are replaced literally, so {{name}} or {{ company }} would be sent as is
+    unfilled = set(re.findall(r'{{.*?}}', object_section + body_section)) - set(EMAIL_PLACEHOLDERS)
+    if unfilled:
+        return (f"Template {template_path} has placeholders that are never filled: {', '.join(sorted(unfilled))} "
+                f"(use {' and '.join(EMAIL_PLACEHOLDERS)})")
+    return None
+
+def validate_templates():
+    """
+    Check every template a batch can use: the CV, and the cover letter and
+    email templates of each language.
+
+    Returns:
+    - Dictionary of template path to problem, empty when every template is usable
+    """
+    checks = [(cv_context('role')[0], lambda path: _docx_problem(path, cv_context('role')[1]))]
+    for language in LANGUAGES:
+        sample = cover_letter_context(language, 'job', 'company', date='date')[1]
+        checks.append((cover_letter_template_path(language), lambda path, sample=sample: _docx_problem(path, sample)))
+        checks.append((email_template_path(language), _email_problem))
+
+    problems = {}
+    for template_path, check in checks:
+        problem = check(template_path)
+        if problem:
+            problems[template_path] = problem
+            logger.error(f"Template problem: {problem}")
+    return problems
+
+def check_fields(fields):
+    """Return why a record cannot be sent, or None if its fields are usable"""
+    email = (fields['email'] or '').strip()
+    local, _, domain = email.rpartition('@')
+    if not email:
+        return "Missing email address"
+    if not local or '.' not in domain or ' ' in email:
+        return f"Invalid email address: {email}"
+    if not (fields['company'] or '').strip():
+        return "Missing company"
+    if not (fields['role'] or '').strip():
+        return "Missing role"
+
+    for name in ('cover_letter_language', 'email_language'):
+        language = (fields[name] or '').lower()
+        if language not in LANGUAGES:
+            return f"Unknown {name.replace('_', ' ')}: {fields[name]}"
+        if not (fields[f'{language}_job'] or '').strip():
+            return f"Missing {language} job title"
+    return None
+
+def plan_email(fields, dates=None):
+    """
+    Resolve everything render_email needs for a record, without generating any file.
+
+    Parameters:
+    - fields: Record fields as returned by extract_record_fields
+    - dates: Optional dictionary of language to cover letter date, computed once per batch
+
+    Returns:
+    - Dictionary with the 'cv' and 'cover_letter' (template path, context)
+      pairs and the email 'subject' and 'body'
+    """
+    cover_letter_language = fields['cover_letter_language']
+    email_language = fields['email_language']
+    details = {'first_name': fields['first_name'], 'last_name': fields['last_name'],
+               'title': fields['title'], 'formality': fields['formality']}
+
+    # Use the appropriate job title based on language
+    job_for_cover_letter = fields['english_job'] if cover_letter_language == 'english' else fields['french_job']
+    job_for_email = fields['english_job'] if email_language == 'english' else fields['french_job']
+
+    # Get email content with subject and body using email_language
+    subject, body = get_email_template(email_language, job_for_email, fields['role'], **details)
+
+    return {
+        'cv': cv_context(fields['role']),
+        'cover_letter': cover_letter_context(cover_letter_language, job_for_cover_letter, fields['company'],
+                                             date=(dates or {}).get(cover_letter_language.lower()), **details),
+        'subject': subject,
+        'body': body,
+    }
+
+def _check_record(fields, template_problems, dates):
+    """Return (problem, plan) for a pending record, problem being None when it can be sent"""
+    problem = check_fields(fields)
+    if problem is None:
+        templates = (cv_context(fields['role'])[0], cover_letter_template_path(fields['cover_letter_language']),
+                     email_template_path(fields['email_language']))
+        problem = next((template_problems[path] for path in templates if path in template_problems), None)
+    if problem is not None:
+        return problem, None
+    try:
+        return None, plan_email(fields, dates)
+    except Exception as e:
+        return str(e), None
+
+def _record_source(records):
+    """Return a callable giving a fresh iterable of the records for each pass"""
+    if callable(records):
+        return records
+    if iter(records) is records:
+        # A one-shot cursor cannot be read twice
+        records = list(records)
+    return lambda: records
+
+def preflight(records, store_errors=True):
+    """
+    Check a batch before anything is rendered, converted or sent.
+
+    Templates are validated and the cover letter dates computed once. A
+    first pass then checks every row and keeps only the IDs and errors of
+    the bad ones, so they are all reported before the first render while
+    memory stays flat. A second pass streams the good rows, each with its
+    render plan. Records already processed or dead-lettered are passed
+    through untouched, for send_records to skip as usual.
+
+    Parameters:
+    - records: A list of database records, or a callable returning a fresh
+      iterable of them (such as a cursor) for each pass. A one-shot iterator
+      is read into a list
+    - store_errors: Store the problem of each bad row as its last error, shown on the main page
+
+    Returns:
+    - Dictionary with:
+      - records: Generator of the records to hand to send_records, bad rows left out
+      - plans: Render plan of each good record handed on and not rendered yet, by ID
+        (see plan_email); send_records removes a plan when it uses it
+      - invalid: Error results of the bad rows. A row that turns bad between
+        the two passes is added when the second pass reaches it
+      - ready: Number of rows that passed the first pass
+      - template_problems: Dictionary of template path to problem
+    """
+    source = _record_source(records)
+    template_problems = validate_templates()
+    # Formatting a date switches the process locale, so it is done once per language
+    dates = {language: get_current_date(language) for language in LANGUAGES}
+    plans, invalid, bad_ids = {}, [], set()
+    ready = 0
+
+    def reject(record_id, message):
+        invalid.append({"id": record_id, "status": "error", "message": message})
+        bad_ids.add(record_id)
+        logger.warning(f"Record ID: {record_id} left out of the batch: {message}")
+
+    # First pass: validation only, nothing but the bad rows is kept
+    for record in source():
+        try:
+            fields = extract_record_fields(record)
+        except Exception as e:
+            reject('unknown', f"Unreadable record: {str(e)}")
+            continue
+        if fields['processed'] or fields['state'] == 'dead':
+            continue
+
+        problem, _ = _check_record(fields, template_problems, dates)
+        if problem:
+            reject(fields['id'], f"Pre-flight check failed: {problem}")
+        else:
+            ready += 1
+
+    if invalid and store_errors:
+        record_preflight_errors([(result['id'], result['message']) for result in invalid if result['id'] != 'unknown'])
+    logger.info(f"Pre-flight check: {ready} records ready to send, {len(invalid)} left out of the batch")
+
+    def good_records():
+        # Second pass: rows are read again, so only what the batch is about to render is held
+        for record in source():
+            try:
+                fields = extract_record_fields(record)
+            except Exception:
+                # Reported by the first pass
+                continue
+            if fields['processed'] or fields['state'] == 'dead':
+                yield record
+                continue
+            if fields['id'] in bad_ids:
+                continue
+
+            # The row may have been edited since the first pass
+            problem, plan = _check_record(fields, template_problems, dates)
+            if problem:
+                reject(fields['id'], f"Pre-flight check failed: {problem}")
+                if store_errors:
+                    record_preflight_errors([(fields['id'], invalid[-1]['message'])])
+                continue
+            plans[fields['id']] = plan
+            yield record
+
+    return {'records': good_records(), 'plans': plans, 'invalid': invalid, 'ready': ready,
+            'template_problems': template_problems}
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the templates and the pending contacts without sending anything.')
+    parser.parse_args()
+
+    setup_logging()
+    init_db()
+    report = preflight(get_all_records(), store_errors=False)
+    for problem in report['template_problems'].values():
+        print(f"Template: {problem}")
+    for result in report['invalid']:
+        print(f"Record {result['id']}: {result['message']}")
+    print(f"{report['ready']} records ready to send, {len(report['invalid'])} with problems")
+    return 1 if report['invalid'] or report['template_problems'] else 0
+
+if __name__ == '__main__':
+    raise SystemExit(main())
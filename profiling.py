@@ -0,0 +1,229 @@
+"""
+Opt-in profiling: per-request reports on the Flask routes and a sampling
+profiler that can be attached to a send job.
+
+Nothing here runs unless it is turned on. Reports and flamegraphs are
+written to logs/profiles.
+"""
+import io
+import os
+import sys
+import time
+import pstats
+import cProfile
+import logging
+import threading
+from html import escape
+from zlib import crc32
+from flask import request, g, make_response
+
+try:
+    from pyinstrument import Profiler
+except ImportError:  # Reports fall back to cProfile
+    Profiler = None
+
+# Setup logging
+logger = logging.getLogger(__name__)
+
+# ?profile=1 on any route returns a profile of the request instead of the page
+PROFILING = os.environ.get('PROFILING', '0') == '1'
+
+# Where reports and flamegraphs are written, next to the logs
+PROFILE_DIR = os.path.join('logs', 'profiles')
+
+# Seconds between two samples of the sampling profiler
+SAMPLE_INTERVAL = float(os.environ.get('PROFILE_SAMPLE_INTERVAL', '0.005'))
+
+# Functions listed in a cProfile report
+REPORT_LINES = 40
+
+# Values of ?profile= that turn profiling on, anything else is ignored
+PROFILE_MODES = ('1', 'cprofile', 'pyinstrument')
+
+def _report_path(name, extension, output_dir=PROFILE_DIR):
+    os.makedirs(output_dir, exist_ok=True)
+    return os.path.join(output_dir, f"{name}-{time.strftime('%Y%m%d-%H%M%S')}.{extension}")
+
+def register_request_profiling(app):
+    """
+    Add ?profile=1 to the routes of a Flask app.
+
+    The request is profiled with pyinstrument when it is installed
+    (?profile=cprofile forces cProfile, ?profile=pyinstrument asks for it
+    explicitly) and the report is returned instead of the page and saved to
+    PROFILE_DIR. Other values of ?profile= are ignored. Only call this when PROFILING is
+    on, so requests pay nothing otherwise.
+    """
+    @app.before_request
+    def start_request_profile():
+        mode = request.args.get('profile')
+        if mode not in PROFILE_MODES:
+            return
+        if Profiler is not None and mode != 'cprofile':
+            g.profiler = Profiler()
+            g.profiler.start()
+        else:
+            g.profiler = cProfile.Profile()
+            g.profiler.enable()
+
+    @app.after_request
+    def return_request_profile(response):
+        profiler = g.pop('profiler', None)
+        if profiler is None:
+            return response
+
+        name = f"request-{request.endpoint or 'unknown'}"
+        if isinstance(profiler, cProfile.Profile):
+            profiler.disable()
+            path = _report_path(name, 'prof')
+            profiler.dump_stats(path)
+            report = io.StringIO()
+            pstats.Stats(profiler, stream=report).sort_stats('cumulative').print_stats(REPORT_LINES)
+            response = make_response(report.getvalue())
+            response.mimetype = 'text/plain'
+        else:
+            profiler.stop()
+            path = _report_path(name, 'html')
+            html = profiler.output_html()
+            with open(path, 'w', encoding='utf-8') as file:
+                file.write(html)
+            response = make_response(html)
+
+        logger.info(f"Profiled {request.full_path}, report saved to {path}")
+        return response
+
+def _frame_name(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+class SamplingProfiler:
+    """
+    Statistical profiler sampling the Python stacks of running threads.
+
+    A background thread reads the stacks every `interval` seconds, so the
+    profiled code runs unmodified and the overhead stays low. Stopping
+    writes a folded stack file (for flamegraph.pl or speedscope) and an SVG
+    flamegraph to PROFILE_DIR (or output_dir).
+    """
+
+    def __init__(self, name, interval=SAMPLE_INTERVAL, thread_ids=None, output_dir=PROFILE_DIR):
+        """
+        Parameters:
+        - name: Prefix of the output files
+        - interval: Seconds between two samples
+        - thread_ids: Identifiers of the threads to sample (None samples every thread)
+        - output_dir: Directory the results are written to
+        """
+        self.name = name
+        self.output_dir = output_dir
+        self.interval = interval
+        self.thread_ids = thread_ids
+        self.stacks = {}
+        self.samples = 0
+        self._thread = None
+        self._stop_event = threading.Event()
+
+    def _sample(self):
+        own = threading.get_ident()
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own or (self.thread_ids is not None and thread_id not in self.thread_ids):
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(_frame_name(frame))
+                frame = frame.f_back
+            stack.append(names.get(thread_id, str(thread_id)))
+            key = ';'.join(reversed(stack))
+            self.stacks[key] = self.stacks.get(key, 0) + 1
+        self.samples += 1
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            self._sample()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+        self._thread.start()
+        logger.info(f"Sampling profiler {self.name} started")
+        return self
+
+    def stop(self):
+        """
+        Stop sampling and write the results.
+
+        Returns:
+        - Path of the SVG flamegraph, or None if nothing was sampled
+        """
+        self._stop_event.set()
+        self._thread.join()
+        if not self.stacks:
+            return None
+
+        folded_path = _report_path(self.name, 'folded', self.output_dir)
+        with open(folded_path, 'w', encoding='utf-8') as file:
+            for stack, count in sorted(self.stacks.items()):
+                file.write(f"{stack} {count}\n")
+
+        svg_path = folded_path[:-len('.folded')] + '.svg'
+        write_flamegraph(self.stacks, svg_path, title=f"{self.name}, {self.samples} samples every {self.interval * 1000:g} ms")
+        logger.info(f"Sampling profiler {self.name} stopped after {self.samples} samples, flamegraph saved to {svg_path}")
+        return svg_path
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+def write_flamegraph(stacks, path, title='', width=1200, row_height=16):
+    """
+    Write folded stacks as an SVG flamegraph, callers on top of their callees.
+
+    Parameters:
+    - stacks: Dictionary of ';'-separated stack to sample count
+    - path: SVG file to write
+    - title: Line shown above the graph
+    """
+    # Merge the stacks into a tree of [count, children]
+    root = [0, {}]
+    for stack, count in stacks.items():
+        node = root
+        node[0] += count
+        for name in stack.split(';'):
+            node = node[1].setdefault(name, [0, {}])
+            node[0] += count
+
+    rects = []
+    depth_max = 0
+
+    def layout(children, x, depth):
+        nonlocal depth_max
+        depth_max = max(depth_max, depth)
+        for name, (count, grandchildren) in sorted(children.items()):
+            span = count / root[0] * width
+            if span >= 0.5:
+                rects.append((x, depth, span, name, count))
+                layout(grandchildren, x, depth + 1)
+            x += span
+
+    layout(root[1], 0, 0)
+    top = 24
+    height = top + (depth_max + 1) * row_height
+
+    parts = [f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}" font-family="monospace" font-size="11">',
+             f'<text x="4" y="16">{escape(title)}</text>']
+    for x, depth, span, name, count in rects:
+        # Stable warm colour per function
+        hue = crc32(name.encode('utf-8')) % 60
+        y = top + depth * row_height
+        label = escape(name[:int(span / 7)]) if span > 21 else ''
+        parts.append(
+            f'<g><title>{escape(name)}: {count} samples ({count / root[0]:.1%})</title>'
+            f'<rect x="{x:.1f}" y="{y}" width="{span:.1f}" height="{row_height - 1}" fill="hsl({hue},80%,60%)"/>'
+            f'<text x="{x + 3:.1f}" y="{y + row_height - 4}">{label}</text></g>'
+        )
+    parts.append('</svg>')
+
+    with open(path, 'w', encoding='utf-8') as file:
+        file.write('\n'.join(parts))
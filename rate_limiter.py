@@ -0,0 +1,68 @@
+import asyncio
+import threading
+import time
+import logging
+
+# Setup logging
+logger = logging.getLogger(__name__)
+
+# Same pace as the historical 2 second pause between emails
+DEFAULT_RATE_PER_MINUTE = 30
+
+class RateLimiter:
+    """
+    Token bucket shared by the synchronous and asyncio send paths.
+
+    Slots are handed out under a thread lock without blocking, so the same
+    limiter can be used from worker threads and from the event loop.
+    """
+
+    def __init__(self, rate_per_minute, burst=1):
+        """
+        Parameters:
+        - rate_per_minute: Maximum number of sends per minute (None or 0 disables the limit)
+        - burst: Number of sends allowed back to back before the rate applies
+        """
+        self.interval = 60.0 / rate_per_minute if rate_per_minute else 0.0
+        self.burst = max(1, int(burst))
+        self._lock = threading.Lock()
+        self._next_slot = time.monotonic()
+
+    def reserve(self):
+        """Reserve the next send slot and return the number of seconds to wait for it"""
+        if not self.interval:
+            return 0.0
+
+        with self._lock:
+            now = time.monotonic()
+            # Unused capacity can accumulate up to the burst size only
+            slot = max(self._next_slot, now - (self.burst - 1) * self.interval)
+            self._next_slot = slot + self.interval
+            return max(0.0, slot - now)
+
+    def penalize(self, slots=1):
+        """
+        Push the next send slot back after a failure.
+
+        Failed sends therefore slow the limiter down instead of letting
+        their retries add to the send rate.
+        """
+        if not self.interval:
+            return
+
+        with self._lock:
+            self._next_slot = max(self._next_slot, time.monotonic()) + slots * self.interval
+
+    def acquire(self):
+        """Block the calling thread until a send slot is available"""
+        delay = self.reserve()
+        if delay:
+            time.sleep(delay)
+        return delay
+
+    async def acquire_async(self):
+        """Wait on the event loop until a send slot is available"""
+        delay = self.reserve()
+        if delay:
+            await asyncio.sleep(delay)
+        return delay
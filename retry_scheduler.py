@@ -0,0 +1,94 @@
+import heapq
+import itertools
+import random
+import time
+import logging
+from database import record_send_failure, mark_as_dead_letter
+
+# Setup logging
+logger = logging.getLogger(__name__)
+
+# Attempts per record (counted across batches) before it moves to dead letter
+DEFAULT_MAX_ATTEMPTS = 3
+
+# Backoff bounds in seconds
+DEFAULT_BASE_DELAY = 5
+DEFAULT_MAX_DELAY = 60
+
+class RetryPolicy:
+    """Exponential backoff with jitter and a maximum number of attempts"""
+
+    def __init__(self, max_attempts=DEFAULT_MAX_ATTEMPTS, base_delay=DEFAULT_BASE_DELAY,
+                 max_delay=DEFAULT_MAX_DELAY, jitter=0.5):
+        """
+        Parameters:
+        - max_attempts: Attempts before a record is moved to dead letter
+        - base_delay: Delay after the first failure, doubled on every further failure
+        - max_delay: Upper bound of the delay
+        - jitter: Fraction of the delay that is randomised (0 disables jitter)
+        """
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+
+    def delay(self, attempts):
+        """Return the delay before the next attempt, given the attempts made so far"""
+        delay = min(self.max_delay, self.base_delay * (2 ** max(0, attempts - 1)))
+        # Spread retries so records that failed together do not retry together
+        return delay * (1 - self.jitter * random.random())
+
+    def exhausted(self, attempts):
+        return attempts >= self.max_attempts
+
+def register_failure(record_id, error, policy):
+    """
+    Store a failed attempt and move the record to dead letter once the policy is exhausted.
+
+    Returns:
+    - Tuple of (attempts, dead)
+    """
+    attempts = record_send_failure(record_id, error)
+    if policy.exhausted(attempts):
+        mark_as_dead_letter(record_id, f"{error} (after {attempts} attempts)")
+        return attempts, True
+    return attempts, False
+
+class RetryQueue:
+    """Min-heap of retries ordered by the time they become due"""
+
+    def __init__(self, clock=time.monotonic, sleep=time.sleep):
+        self._clock = clock
+        self._sleep = sleep
+        self._heap = []
+        self._counter = itertools.count()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def schedule(self, delay, item):
+        """Queue an item to be retried after the given delay"""
+        heapq.heappush(self._heap, (self._clock() + delay, next(self._counter), item))
+
+    def pop_due(self):
+        """Remove and return every item that is due now"""
+        now = self._clock()
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            due.append(heapq.heappop(self._heap)[2])
+        return due
+
+    def pop_all(self):
+        """Remove and return every item, due or not"""
+        items = [entry[2] for entry in sorted(self._heap)]
+        self._heap = []
+        return items
+
+    def wait(self, max_wait=None):
+        """Sleep until the next item is due, or for at most max_wait seconds"""
+        if self._heap:
+            delay = self._heap[0][0] - self._clock()
+            if max_wait is not None:
+                delay = min(delay, max_wait)
+            if delay > 0:
+                self._sleep(delay)
@@ -0,0 +1,196 @@
+"""
+Background process running the send batches queued by the web server.
+
+Web requests only queue a job (see database.enqueue_send_job), so a long
+batch never holds a web worker. Run one send worker next to the web server:
+
+    python send_worker.py
+
+SIGTERM or Ctrl+C drains the worker: the message being sent is finished,
+no further record is started, and the job goes back to the queue so the
+next start picks up the records that are still pending.
+
+To see where a slow job spends its time, run the worker with --profile
+(or PROFILE_SEND_JOBS=1) to get a flamegraph of every job in logs/profiles,
+or send SIGUSR1 to a running worker to start sampling and again to stop.
+"""
+import os
+import socket
+import signal
+import logging
+import argparse
+import threading
+from database import (init_db, recover_stuck_claims, claim_send_job, finish_send_job, recover_send_jobs,
+                      get_all_records, get_records_by_ids, iter_sendable_contacts)
+from email_sender import process_email_queue, send_selected_emails
+from sender_accounts import AccountPool, load_accounts
+from storage import start_up, enforce_retention, OUTPUT_DIR
+from logging_config import setup_logging
+from profiling import SamplingProfiler
+
+# Setup logging
+logger = logging.getLogger(__name__)
+
+# Seconds between two looks at the job queue when it is empty
+JOB_POLL_SECONDS = float(os.environ.get('SEND_JOB_POLL_SECONDS', '2'))
+
+# Sample every job with the sampling profiler
+PROFILE_SEND_JOBS = os.environ.get('PROFILE_SEND_JOBS', '0') == '1'
+
+def worker_name():
+    """Name stored on the jobs a worker runs, unique per process"""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def job_records(job):
+    """
+    Resolve the records of a job when it starts, so edits made while it was queued are honoured.
+
+    Returns:
+    - List of database records, or for a search a callable returning a fresh
+      cursor, so the pre-flight check can read it twice without loading it
+    """
+    payload = job['payload']
+    if job['kind'] == 'all':
+        return get_all_records()
+    if job['kind'] == 'selected':
+        # Deleted records are simply not returned
+        return get_records_by_ids(payload.get('ids', []))
+    if job['kind'] == 'filter':
+        return lambda: iter_sendable_contacts(payload.get('q', ''), payload.get('filters', {}))
+    raise ValueError(f"Unknown send job kind: {job['kind']}")
+
+def summarize(results):
+    counts = {}
+    for result in results:
+        counts[result['status']] = counts.get(result['status'], 0) + 1
+    return ', '.join(f"{count} {status}" for status, count in sorted(counts.items())) or 'no records'
+
+def run_job(job, output_dir=OUTPUT_DIR, accounts=None, stop_event=None, profile=False):
+    """
+    Send the records of one job and store its outcome.
+
+    Parameters:
+    - job: Job as returned by claim_send_job
+    - output_dir: Directory to store generated files
+    - accounts: AccountPool the records are spread across
+    - stop_event: threading.Event set to drain the worker
+    - profile: Write a flamegraph of the job to logs/profiles
+
+    Returns:
+    - List of results for each record processed
+    """
+    should_stop = stop_event.is_set if stop_event else None
+    logger.info(f"Running send job {job['id']} ({job['kind']})")
+
+    profiler = None
+    if profile:
+        profiler = SamplingProfiler(f"send-job-{job['id']}", thread_ids={threading.get_ident()}).start()
+
+    try:
+        records = job_records(job)
+        if job['kind'] == 'all':
+            results = process_email_queue(records, output_dir, accounts=accounts, should_stop=should_stop)
+        else:
+            results = send_selected_emails(records, output_dir, accounts=accounts, should_stop=should_stop)
+    except Exception as e:
+        logger.error(f"Send job {job['id']} failed: {str(e)}")
+        finish_send_job(job['id'], 'failed', str(e))
+        return []
+    finally:
+        if profiler:
+            profiler.stop()
+
+    summary = summarize(results)
+    if stop_event and stop_event.is_set():
+        # Sent records are skipped when the job runs again, the rest are still pending
+        finish_send_job(job['id'], 'queued', f"Interrupted by shutdown after {summary}")
+        logger.warning(f"Send job {job['id']} interrupted by shutdown after {summary}, queued again")
+    else:
+        finish_send_job(job['id'], 'done', summary)
+        logger.info(f"Send job {job['id']} done: {summary}")
+
+    enforce_retention(output_dir=output_dir)
+    return results
+
+def serve(output_dir=OUTPUT_DIR, accounts=None, stop_event=None, poll_seconds=JOB_POLL_SECONDS, profile=PROFILE_SEND_JOBS):
+    """
+    Run queued jobs one after the other until stop_event is set, after
+    cleaning up the output directory.
+
+    Parameters:
+    - output_dir: Directory to store generated files
+    - accounts: AccountPool the records are spread across (loaded from the accounts file by default)
+    - stop_event: threading.Event stopping the loop once set
+    - poll_seconds: Seconds between two looks at an empty queue
+    - profile: Write a flamegraph of every job to logs/profiles
+    """
+    stop_event = stop_event or threading.Event()
+    accounts = accounts or AccountPool(load_accounts())
+    name = worker_name()
+    # Restarting the web server must not touch files a batch is writing, so only the worker cleans up
+    start_up(output_dir)
+    logger.info(f"Send worker {name} started")
+
+    while not stop_event.is_set():
+        job = claim_send_job(name)
+        if job is None:
+            stop_event.wait(poll_seconds)
+            continue
+        run_job(job, output_dir, accounts, stop_event, profile)
+
+    logger.info(f"Send worker {name} stopped")
+
+def start_in_thread(output_dir=OUTPUT_DIR, accounts=None):
+    """
+    Run the send worker in a daemon thread of the current process, for the development server.
+
+    Returns:
+    - The threading.Event stopping the worker
+    """
+    stop_event = threading.Event()
+    thread = threading.Thread(target=serve, args=(output_dir, accounts, stop_event), name='send-worker', daemon=True)
+    thread.start()
+    return stop_event
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the send jobs queued by the web server.')
+    parser.add_argument('--output-dir', default=OUTPUT_DIR, help='Directory to store generated files')
+    parser.add_argument('--poll', type=float, default=JOB_POLL_SECONDS, help='Seconds between looks at an empty queue')
+    parser.add_argument('--profile', action='store_true', default=PROFILE_SEND_JOBS,
+                        help='Write a flamegraph of every job to logs/profiles')
+    args = parser.parse_args()
+
+    setup_logging()
+    init_db()
+    recover_stuck_claims()
+    # Jobs left running by a crashed worker; only one send worker runs at a time
+    recover_send_jobs()
+
+    stop_event = threading.Event()
+
+    def drain(signum, frame):
+        logger.warning(f"Received signal {signum}, finishing the message in flight before stopping")
+        stop_event.set()
+
+    signal.signal(signal.SIGTERM, drain)
+    signal.signal(signal.SIGINT, drain)
+
+    # SIGUSR1 attaches the sampling profiler to the job running now, and detaches it (POSIX only)
+    sampler = None
+    main_thread = threading.get_ident()
+
+    def toggle_profiler(signum, frame):
+        nonlocal sampler
+        if sampler is None:
+            sampler = SamplingProfiler('send-worker', thread_ids={main_thread}).start()
+        else:
+            sampler.stop()
+            sampler = None
+
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, toggle_profiler)
+
+    serve(args.output_dir, stop_event=stop_event, poll_seconds=args.poll, profile=args.profile)
+
+if __name__ == '__main__':
+    main()
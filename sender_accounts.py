@@ -0,0 +1,171 @@
+import os
+import json
+import logging
+import threading
+from datetime import date
+from email_sender import OutlookTransport, OUTLOOK_ACCOUNT
+from smtp_transport import SmtpTransport, SMTP_HOST, SMTP_PORT, SMTP_USE_TLS
+from rate_limiter import RateLimiter, DEFAULT_RATE_PER_MINUTE
+from database import assign_sender, get_sender_assignment, reserve_account_quota, release_account_quota, get_account_usage
+
+# Setup logging
+logger = logging.getLogger(__name__)
+
+# JSON file listing the sender accounts, see README
+SENDER_ACCOUNTS_FILE = os.environ.get('SENDER_ACCOUNTS_FILE', 'accounts.json')
+
+TRANSPORTS = ('outlook', 'smtp')
+
+class SenderAccount:
+    """
+    One mailbox that messages can be sent from, with its own transport,
+    credentials, send rate and daily quota.
+    """
+
+    def __init__(self, name, address, transport='outlook', rate_per_minute=DEFAULT_RATE_PER_MINUTE,
+                 daily_quota=None, host=SMTP_HOST, port=SMTP_PORT, username='', password_env='', use_tls=SMTP_USE_TLS):
+        """
+        Parameters:
+        - name: Unique account name, stored in the database
+        - address: Sender address (the Outlook account display name for Outlook)
+        - transport: 'outlook' or 'smtp'
+        - rate_per_minute: Maximum sends per minute from this account
+        - daily_quota: Maximum messages per day (None for no quota)
+        - host, port, username, use_tls: SMTP settings
+        - password_env: Environment variable holding the SMTP password,
+          so no secret is written in the accounts file
+        """
+        if transport not in TRANSPORTS:
+            raise ValueError(f"Unknown transport for account {name}: {transport}")
+
+        self.name = name
+        self.address = address
+        self.transport = transport
+        self.daily_quota = daily_quota
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password_env = password_env
+        self.use_tls = use_tls
+        self.limiter = RateLimiter(rate_per_minute)
+
+    def make_transport(self):
+        """Create a transport sending from this account"""
+        if self.transport == 'outlook':
+            return OutlookTransport(account=self.address)
+        return SmtpTransport(host=self.host, port=self.port, username=self.username,
+                             password=os.environ.get(self.password_env, '') if self.password_env else '',
+                             use_tls=self.use_tls, sender=self.address)
+
+    def __repr__(self):
+        return f"SenderAccount({self.name!r}, {self.address!r}, {self.transport!r})"
+
+def load_accounts(path=SENDER_ACCOUNTS_FILE):
+    """
+    Read the sender accounts from a JSON file.
+
+    The file holds a list of objects with the keyword arguments of
+    SenderAccount. Without the file, the single Outlook account
+    OUTLOOK_ACCOUNT is used.
+
+    Returns:
+    - List of SenderAccount
+    """
+    if not os.path.exists(path):
+        return [SenderAccount('default', OUTLOOK_ACCOUNT)]
+
+    with open(path, encoding='utf-8') as file:
+        accounts = [SenderAccount(**settings) for settings in json.load(file)]
+
+    names = [account.name for account in accounts]
+    if not accounts or len(set(names)) != len(names):
+        raise ValueError(f"{path} must list at least one account, with unique names")
+
+    logger.info(f"Loaded {len(accounts)} sender accounts from {path}: {', '.join(names)}")
+    return accounts
+
+def company_key(fields):
+    """Key sender assignments are sticky on: the company, or the recipient domain without one"""
+    company = (fields.get('company') or '').strip().lower()
+    if company:
+        return company
+    return (fields.get('email') or '').rsplit('@', 1)[-1].strip().lower()
+
+class AccountPool:
+    """
+    Spreads records across sender accounts.
+
+    Every company is assigned an account the first time it is sent to and
+    keeps it afterwards. New companies go to the account that used the
+    smallest share of its daily quota today. A message is counted against its account's daily quota when
+    it is assigned; the count is given back if the message is not sent.
+    """
+
+    def __init__(self, accounts, today=date.today):
+        """
+        Parameters:
+        - accounts: List of SenderAccount
+        - today: Callable returning the current date, replaceable in tests
+        """
+        self.accounts = {account.name: account for account in accounts}
+        self.today = today
+        # Assigning is a read then a write, serialised within the process
+        self._lock = threading.Lock()
+
+    def _day(self):
+        return self.today().isoformat()
+
+    def _least_used(self, day):
+        usage = get_account_usage(day)
+        quotas = [account.daily_quota for account in self.accounts.values() if account.daily_quota]
+        # Accounts without a quota weigh as much as the largest quota
+        default_capacity = max(quotas) if quotas else 1
+
+        def load(account):
+            used = usage.get(account.name, 0)
+            return used / (account.daily_quota or default_capacity), -(account.daily_quota or default_capacity)
+
+        candidates = [account for account in self.accounts.values()
+                      if account.daily_quota is None or usage.get(account.name, 0) < account.daily_quota]
+        if not candidates:
+            return None
+        # Share of quota used, so larger accounts take proportionally more companies
+        return min(candidates, key=load)
+
+    def acquire(self, fields):
+        """
+        Pick the sender account for a record and count the message against its quota.
+
+        Returns:
+        - Tuple of (account, None), or (None, reason) when the record has to
+          wait because its account reached its daily quota
+        """
+        day = self._day()
+        key = company_key(fields)
+
+        with self._lock:
+            name = get_sender_assignment(key)
+            account = self.accounts.get(name)
+            if account is None:
+                if name:
+                    logger.warning(f"Sender account {name} of {key} is no longer configured, reassigning")
+                account = self._least_used(day)
+                if account is None:
+                    return None, "Every sender account reached its daily quota"
+                # A company whose account was removed is moved to the new one
+                name = assign_sender(key, account.name, replace=bool(name))
+                account = self.accounts.get(name, account)
+
+            if not reserve_account_quota(account.name, day, account.daily_quota):
+                return None, f"Sender account {account.name} reached its daily quota of {account.daily_quota}"
+
+        return account, None
+
+    def release(self, account):
+        """Give back the quota of a message that was not sent"""
+        release_account_quota(account.name, self._day())
+
+    def usage(self):
+        """Messages counted today per account"""
+        usage = get_account_usage(self._day())
+        return {name: usage.get(name, 0) for name in self.accounts}
@@ -0,0 +1,118 @@
+import os
+import ssl
+import smtplib
+import logging
+import mimetypes
+from email.message import EmailMessage
+
+# Setup logging
+logger = logging.getLogger(__name__)
+
+# SMTP settings, overridable through the environment
+SMTP_HOST = os.environ.get('SMTP_HOST', 'localhost')
+SMTP_PORT = int(os.environ.get('SMTP_PORT', '25'))
+SMTP_USERNAME = os.environ.get('SMTP_USERNAME', '')
+SMTP_PASSWORD = os.environ.get('SMTP_PASSWORD', '')
+SMTP_USE_TLS = os.environ.get('SMTP_USE_TLS', '0') == '1'
+SMTP_SENDER = os.environ.get('SMTP_SENDER', 'justin.isambert@edhec.com')
+
+def build_message(sender, to_email, subject, body, attachments=None):
+    """
+    Build a MIME message with the given attachments.
+
+    Missing attachments are logged and skipped, like in the Outlook path.
+    """
+    message = EmailMessage()
+    message['From'] = sender
+    message['To'] = to_email
+    message['Subject'] = subject
+    message.set_content(body)
+
+    for attachment in attachments or []:
+        if not os.path.exists(attachment):
+            logger.warning(f"Attachment not found: {attachment}")
+            continue
+
+        content_type, _ = mimetypes.guess_type(attachment)
+        maintype, subtype = (content_type or 'application/octet-stream').split('/', 1)
+        with open(attachment, 'rb') as file:
+            message.add_attachment(
+                file.read(), maintype=maintype, subtype=subtype,
+                filename=os.path.basename(attachment)
+            )
+
+    return message
+
+class SmtpTransport:
+    """
+    SMTP transport that keeps one connection open across sends.
+
+    The connection is opened lazily and re-opened once if the server dropped
+    it between two messages.
+    """
+
+    def __init__(self, host=SMTP_HOST, port=SMTP_PORT, username=SMTP_USERNAME,
+                 password=SMTP_PASSWORD, use_tls=SMTP_USE_TLS, sender=SMTP_SENDER, timeout=30):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.use_tls = use_tls
+        self.sender = sender
+        self.timeout = timeout
+        self._smtp = None
+
+    def connect(self):
+        """Open the SMTP connection if it is not already open"""
+        if self._smtp is not None:
+            return self._smtp
+
+        smtp = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        try:
+            if self.use_tls:
+                smtp.starttls(context=ssl.create_default_context())
+            if self.username:
+                smtp.login(self.username, self.password)
+        except Exception:
+            smtp.close()
+            raise
+
+        logger.info(f"Connected to SMTP server {self.host}:{self.port}")
+        self._smtp = smtp
+        return smtp
+
+    def send(self, to_email, subject, body, attachments=None):
+        """
+        Send an email over the open connection.
+
+        Returns:
+        - True if successful, False otherwise
+        """
+        try:
+            message = build_message(self.sender, to_email, subject, body, attachments)
+            try:
+                self.connect().send_message(message)
+            except smtplib.SMTPServerDisconnected:
+                # The server closed an idle connection, retry once on a fresh one
+                self._smtp = None
+                self.connect().send_message(message)
+
+            logger.info(f"Email sent to {to_email} via SMTP {self.host}:{self.port}")
+            return True
+
+        except Exception as e:
+            logger.error(f"Error sending email via SMTP: {str(e)}")
+            self.close()
+            return False
+
+    def close(self):
+        """Close the SMTP connection"""
+        if self._smtp is None:
+            return
+
+        try:
+            self._smtp.quit()
+        except Exception:
+            self._smtp.close()
+        finally:
+            self._smtp = None
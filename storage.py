@@ -0,0 +1,199 @@
+import os
+import time
+import shutil
+import logging
+import tempfile
+from database import record_artifact, find_artifact, get_artifacts, delete_artifacts
+
+# Setup logging
+logger = logging.getLogger(__name__)
+
+# Directory owned by the storage manager
+OUTPUT_DIR = 'output'
+
+# Retention limits, overridable through the environment
+OUTPUT_MAX_AGE_DAYS = float(os.environ.get('OUTPUT_MAX_AGE_DAYS', '30'))
+OUTPUT_MAX_BYTES = int(os.environ.get('OUTPUT_MAX_BYTES', str(500 * 1024 * 1024)))
+
+# Standalone downloads are cached in this subdirectory of the output directory
+DOWNLOADS_DIR = 'downloads'
+
+# Leftovers of an interrupted render or cache write
+TEMP_SUFFIXES = ('_temp.docx', '.tmp')
+
+# Temporary files and directories younger than this may belong to a render or
+# download still running in another process, so cleanup leaves them alone
+CLEANUP_GRACE_SECONDS = float(os.environ.get('OUTPUT_CLEANUP_GRACE_SECONDS', '600'))
+
+def _normalize(path):
+    return os.path.normpath(path)
+
+def ensure_dir(path=OUTPUT_DIR):
+    """Create a directory under the output directory if needed and return it"""
+    os.makedirs(path, exist_ok=True)
+    return path
+
+def track(path, kind, cache_key=None, contact_id=None):
+    """
+    Record a generated file in the manifest so retention can account for it.
+
+    Parameters:
+    - path: Generated file
+    - kind: Artifact type (cv, cover_letter, pdf_cache, download...)
+    - cache_key: Input hash the file can be looked up by
+    - contact_id: Contact the file was rendered for
+    """
+    record_artifact(_normalize(path), kind, os.path.getsize(path), cache_key, contact_id)
+    return path
+
+def lookup(cache_key, kind):
+    """Return the cached artifact for an input hash, or None if there is none on disk"""
+    path = find_artifact(cache_key, kind)
+    if path and not os.path.exists(path):
+        delete_artifacts([path])
+        return None
+    return path
+
+def cached_document(cache_key, kind, build, output_dir=OUTPUT_DIR):
+    """
+    Return a cached document, building it on a cache miss.
+
+    Parameters:
+    - cache_key: Input hash of the document
+    - kind: Artifact type
+    - build: Callable taking a directory and returning the path of the file it generated there
+    - output_dir: Output directory
+
+    Returns:
+    - Path of the cached document
+    """
+    path = lookup(cache_key, kind)
+    if path:
+        logger.info(f"Serving cached {kind} {os.path.basename(path)}")
+        return path
+
+    downloads_dir = ensure_dir(os.path.join(output_dir, DOWNLOADS_DIR))
+
+    # Build in a private directory so concurrent requests never share temp files
+    build_dir = tempfile.mkdtemp(dir=downloads_dir)
+    try:
+        built = build(build_dir)
+        path = os.path.join(downloads_dir, f"{kind}-{cache_key}{os.path.splitext(built)[1]}")
+        os.replace(built, path)
+    finally:
+        shutil.rmtree(build_dir, ignore_errors=True)
+
+    return track(path, kind, cache_key)
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+def _is_recent(path):
+    try:
+        return time.time() - os.path.getmtime(path) < CLEANUP_GRACE_SECONDS
+    except OSError:
+        # Already gone
+        return True
+
+def _remove_empty_dirs(output_dir):
+    for root, dirs, files in os.walk(output_dir, topdown=False):
+        if root != output_dir and not os.listdir(root) and not _is_recent(root):
+            try:
+                os.rmdir(root)
+            except OSError:
+                # A render started writing into it
+                pass
+
+def cleanup_orphans(output_dir=OUTPUT_DIR):
+    """
+    Bring the output directory and the manifest back in line, typically at start-up.
+
+    - Temporary docx files and partial cache files left by a crash are deleted,
+      unless they are younger than CLEANUP_GRACE_SECONDS and may still be in use.
+    - Manifest entries whose file is gone are dropped.
+    - Finished files missing from the manifest are added to it, so retention covers them.
+
+    Returns:
+    - Number of files deleted
+    """
+    ensure_dir(output_dir)
+    known = {artifact['path'] for artifact in get_artifacts()}
+    on_disk = set()
+    removed = 0
+
+    for root, dirs, files in os.walk(output_dir):
+        for name in files:
+            path = _normalize(os.path.join(root, name))
+            if name.endswith(TEMP_SUFFIXES):
+                if not _is_recent(path):
+                    _remove(path)
+                    removed += 1
+            elif path not in known:
+                track(path, 'untracked')
+                on_disk.add(path)
+            else:
+                on_disk.add(path)
+
+    # Private build directories of interrupted downloads
+    downloads_dir = os.path.join(output_dir, DOWNLOADS_DIR)
+    if os.path.isdir(downloads_dir):
+        for name in os.listdir(downloads_dir):
+            path = os.path.join(downloads_dir, name)
+            if os.path.isdir(path) and not _is_recent(path):
+                removed += sum(len(files) for _, _, files in os.walk(path))
+                shutil.rmtree(path, ignore_errors=True)
+
+    missing = known - on_disk
+    if missing:
+        delete_artifacts(missing)
+    _remove_empty_dirs(output_dir)
+
+    if removed or missing:
+        logger.warning(f"Cleaned up output directory: {removed} orphaned files deleted, {len(missing)} stale manifest entries dropped")
+    return removed
+
+def enforce_retention(max_age_days=None, max_bytes=None, output_dir=OUTPUT_DIR):
+    """
+    Delete artifacts older than the age limit, then the least recently used
+    ones until the output directory fits in the size limit.
+
+    Files of a record that is currently being sent are never deleted.
+
+    Parameters:
+    - max_age_days: Maximum days since last use (default OUTPUT_MAX_AGE_DAYS)
+    - max_bytes: Maximum total size of the artifacts (default OUTPUT_MAX_BYTES)
+    - output_dir: Output directory
+
+    Returns:
+    - Number of files deleted
+    """
+    max_age_days = OUTPUT_MAX_AGE_DAYS if max_age_days is None else max_age_days
+    max_bytes = OUTPUT_MAX_BYTES if max_bytes is None else max_bytes
+
+    artifacts = [artifact for artifact in get_artifacts() if artifact['contact_state'] != 'sending']
+    cutoff = time.time() - max_age_days * 86400
+    total = sum(artifact['size'] for artifact in artifacts)
+    expired = []
+
+    # Oldest first, so the size limit evicts the least recently used files
+    for artifact in artifacts:
+        if artifact['last_used_at'] < cutoff or total > max_bytes:
+            expired.append(artifact['path'])
+            total -= artifact['size']
+
+    for path in expired:
+        _remove(path)
+    if expired:
+        delete_artifacts(expired)
+        _remove_empty_dirs(output_dir)
+        logger.info(f"Retention removed {len(expired)} files, {total} bytes kept in {output_dir}")
+    return len(expired)
+
+def start_up(output_dir=OUTPUT_DIR):
+    """Prepare the output directory when the application starts"""
+    ensure_dir(output_dir)
+    cleanup_orphans(output_dir)
+    enforce_retention(output_dir=output_dir)
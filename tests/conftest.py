@@ -0,0 +1,25 @@
+import pytest
+import database
+import email_sender
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """Point the application at an empty SQLite file in a temporary directory"""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(database, 'DATABASE_FILE', str(tmp_path / 'email_data.db'))
+    database.init_db()
+    return tmp_path
+
+@pytest.fixture
+def no_render(monkeypatch):
+    """Skip the document rendering, every message goes out without attachments"""
+    monkeypatch.setattr(email_sender, 'render_email', lambda fields, output_dir='output', plan=None: ('Subject', 'Body', []))
+
+def add_contacts(count):
+    """Add pending contacts and return their IDs"""
+    return [database.add_record(f'contact{i}@example{i % 3}.com', 'Analyst', 'Analyste', f'Company {i}', 'Marie', 'Dupont',
+                                'Mme', 'formal', 'Quant Analyst', 'english', 'english')
+            for i in range(count)]
+
+def get_contact(id):
+    return database.get_all_records(id)
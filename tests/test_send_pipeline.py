@@ -0,0 +1,94 @@
+import threading
+import time
+import pytest
+from conftest import add_contacts, get_contact
+from database import get_all_records, claim_record, begin_send, recover_stuck_claims, get_ledger_status
+from email_sender import send_records, message_key
+from preflight import extract_record_fields
+from rate_limiter import RateLimiter
+from retry_scheduler import RetryPolicy
+
+# Retries without waiting, so the tests do not sleep through the backoff
+NO_BACKOFF = RetryPolicy(max_attempts=3, base_delay=0, max_delay=0, jitter=0)
+
+class RecordingSend:
+    """Send callable counting the messages per recipient"""
+
+    def __init__(self, result=True, latency=0.0):
+        self.result = result
+        self.latency = latency
+        self.sent = []
+        self._lock = threading.Lock()
+
+    def __call__(self, to_email, subject, body, attachments=None):
+        time.sleep(self.latency)
+        with self._lock:
+            self.sent.append(to_email)
+        return self.result
+
+def test_overlapping_batches_send_each_record_once(db, no_render):
+    ids = add_contacts(20)
+    records = get_all_records()
+    send = RecordingSend(latency=0.01)
+
+    batches = [threading.Thread(target=send_records, args=(records,),
+                                kwargs={'send': send, 'limiter': RateLimiter(None), 'policy': NO_BACKOFF})
+               for _ in range(2)]
+    for batch in batches:
+        batch.start()
+    for batch in batches:
+        batch.join()
+
+    assert sorted(send.sent) == sorted(record['email'] for record in records)
+    assert all(get_contact(id)['state'] == 'sent' for id in ids)
+
+def test_crash_after_begin_send_recovers_to_unknown_and_dead_letter(db, no_render):
+    id = add_contacts(1)[0]
+    fields = extract_record_fields(get_contact(id))
+    key = message_key(fields)
+
+    # The batch claimed the record and handed the message over, then died
+    assert claim_record(id, lease_seconds=-1)
+    assert begin_send(key, id, fields['email'])
+
+    assert recover_stuck_claims() == 1
+    assert get_ledger_status(key) == 'unknown'
+    contact = get_contact(id)
+    assert contact['state'] == 'dead'
+
+    # The message may have gone out, so later batches leave it alone
+    send = RecordingSend()
+    results = send_records([contact], send=send, limiter=RateLimiter(None), policy=NO_BACKOFF)
+    assert send.sent == []
+    assert results[0]['status'] == 'skipped'
+
+def test_retries_stop_at_max_attempts(db, no_render):
+    id = add_contacts(1)[0]
+    send = RecordingSend(result=False)
+
+    results = send_records(get_all_records(), send=send, limiter=RateLimiter(None), policy=NO_BACKOFF)
+
+    assert len(send.sent) == NO_BACKOFF.max_attempts
+    assert 'moved to dead letter' in results[0]['message']
+    contact = get_contact(id)
+    assert contact['state'] == 'dead'
+    assert contact['send_attempts'] == NO_BACKOFF.max_attempts
+
+    # A dead letter is not retried by the next batch
+    send_records([contact], send=send, limiter=RateLimiter(None), policy=NO_BACKOFF)
+    assert len(send.sent) == NO_BACKOFF.max_attempts
+
+def test_penalize_slows_the_limiter():
+    steady = RateLimiter(60)
+    penalized = RateLimiter(60)
+    for limiter in (steady, penalized):
+        limiter.reserve()
+
+    penalized.penalize()
+
+    assert penalized.reserve() == pytest.approx(steady.reserve() + steady.interval, abs=0.05)
+
+def test_penalize_without_a_rate_is_a_no_op():
+    limiter = RateLimiter(None)
+    limiter.penalize()
+    assert limiter.reserve() == 0.0
@@ -0,0 +1,24 @@
+"""
+WSGI entry point for production servers.
+
+Linux and macOS, with the settings of gunicorn.conf.py:
+
+    gunicorn wsgi:app
+
+Windows, where gunicorn does not run (and Outlook does), with waitress:
+
+    python wsgi.py
+
+Either way, run python send_worker.py next to it to send the queued batches.
+"""
+import os
+from app import app
+
+# Settings of the waitress server started by python wsgi.py
+HOST = os.environ.get('HOST', '127.0.0.1')
+PORT = int(os.environ.get('PORT', '8000'))
+WEB_THREADS = int(os.environ.get('WEB_THREADS', '8'))
+
+if __name__ == '__main__':
+    from waitress import serve
+    serve(app, host=HOST, port=PORT, threads=WEB_THREADS)